@@ -0,0 +1,96 @@
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+
+ANSWER_CACHE_PATH = "./answer_cache.sqlite"
+
+def context_fingerprint(docs):
+    """Identify a retrieved context by its chunk IDs (or content, for chunks without one), order-independent."""
+    keys = []
+    for doc in docs:
+        chunk_id = getattr(doc, "id", None)
+        if not chunk_id:
+            chunk_id = hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+        keys.append(chunk_id)
+    return hashlib.sha256("\n".join(sorted(keys)).encode("utf-8")).hexdigest()
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class AnswerCache:
+    """
+    Persistent cache of finished answers for near-duplicate questions.
+
+    An entry is reused only when the retrieved context fingerprint matches exactly and the
+    question embedding is at least `threshold` cosine-similar. Entries belong to one
+    knowledge-base version; opening the cache with a different version drops the rest.
+    At most `max_entries` are kept, evicting the least recently used.
+    """
+
+    def __init__(self, path=ANSWER_CACHE_PATH, threshold=0.95, max_entries=1000, kb_version=""):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            " id INTEGER PRIMARY KEY, kb_version TEXT NOT NULL, fingerprint TEXT NOT NULL,"
+            " embedding BLOB NOT NULL, question TEXT NOT NULL, answer TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answers_fingerprint ON answers (fingerprint)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)")
+        self.conn.commit()
+        self.set_kb_version(kb_version)
+
+    def set_kb_version(self, kb_version):
+        """Switch to a new knowledge-base version, invalidating every answer from other versions."""
+        with self.lock:
+            self.kb_version = kb_version
+            self.conn.execute("DELETE FROM answers WHERE kb_version != ?", (kb_version,))
+            self.conn.commit()
+
+    def lookup(self, embedding, fingerprint):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, embedding, answer FROM answers WHERE fingerprint = ? AND kb_version = ?",
+                (fingerprint, self.kb_version),
+            ).fetchall()
+            best_id, best_answer, best_score = None, None, self.threshold
+            for row_id, blob, answer in rows:
+                score = cosine_similarity(embedding, array("f", blob))
+                if score >= best_score:
+                    best_id, best_answer, best_score = row_id, answer, score
+            if best_id is not None:
+                self.conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (time.time(), best_id))
+                self.conn.commit()
+            return best_answer
+
+    def store(self, question, embedding, fingerprint, answer):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO answers (kb_version, fingerprint, embedding, question, answer, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (self.kb_version, fingerprint, array("f", embedding).tobytes(), question, answer, time.time()),
+            )
+            self.conn.execute(
+                "DELETE FROM answers WHERE id IN ("
+                " SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM answers")
+            self.conn.commit()
+
+def replay(answer, piece_size=16):
+    """Yield a cached answer in small pieces, like a streamed completion."""
+    for i in range(0, len(answer), piece_size):
+        yield answer[i:i + piece_size]
@@ -0,0 +1,164 @@
+"""
+Answer a file of questions in one run, e.g. for study guides or answer regression checks.
+
+    python batch_qa.py questions.jsonl -o answers.jsonl --concurrency 8
+
+Input is JSONL ({"id": ..., "question": ...} per line; "query" is accepted too) or plain
+text with one question per line, whose line number becomes its id. Each answer is written
+to the output as soon as it is complete, so lines appear in completion order; match them
+to the input by "id". Questions are answered independently, without conversation memory.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from dotenv import load_dotenv
+from llm_client import EndpointsFailed
+
+load_dotenv()
+
+# LLM calls in flight at once; throughput scales with this until the API rate-limits.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 4))
+BATCH_RETRIES = int(os.getenv("BATCH_RETRIES", 3))
+# Exponential backoff between retries: BATCH_BACKOFF * 2**attempt seconds, jittered, capped.
+BATCH_BACKOFF = float(os.getenv("BATCH_BACKOFF", 1.0))
+BATCH_BACKOFF_MAX = float(os.getenv("BATCH_BACKOFF_MAX", 30.0))
+# Questions embedded and searched together; the first answers start after the first batch.
+BATCH_RETRIEVAL_SIZE = int(os.getenv("BATCH_RETRIEVAL_SIZE", 64))
+
+def read_questions(path):
+    """[(id, question)] from a JSONL or plain-text file."""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        jsonl = path.endswith((".jsonl", ".json"))
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if jsonl:
+                item = json.loads(line)
+                question = (item.get("question") or item.get("query") or "").strip()
+                question_id = item.get("id", line_no)
+            else:
+                question, question_id = line, line_no
+            if question:
+                questions.append((question_id, question))
+    return questions
+
+try:
+    from openai import APIConnectionError
+except ImportError:
+    APIConnectionError = ConnectionError
+
+# Raised when nothing came back in time or the connection dropped; APITimeoutError is an APIConnectionError.
+TRANSIENT_ERRORS = (TimeoutError, asyncio.TimeoutError, ConnectionError, APIConnectionError)
+
+def is_retryable(error):
+    """Rate limits, timeouts, dropped connections and 5xx are retried; everything else is not."""
+    if isinstance(error, EndpointsFailed):
+        # Worth another round only if every endpoint failed for a transient reason.
+        return bool(error.errors) and all(is_retryable(cause) for _, cause in error.errors)
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True
+    status = getattr(error, "status_code", None)
+    return isinstance(status, int) and (status in (408, 409, 429) or status >= 500)
+
+def source_page(doc):
+    """1-based page number from a document's metadata, or None when it has none."""
+    page = doc.metadata.get("page")
+    return page + 1 if isinstance(page, int) else None
+
+async def ask(llm, messages, retries=BATCH_RETRIES):
+    """(answer, attempts) for one prompt, retrying transient failures with jittered exponential backoff."""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            message = await llm.ainvoke(messages)
+            return message.content, attempt
+        except Exception as e:
+            if attempt > retries or not is_retryable(e):
+                raise
+            delay = min(BATCH_BACKOFF_MAX, BATCH_BACKOFF * 2 ** (attempt - 1))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+async def answer_all(ai, questions, out, concurrency=BATCH_CONCURRENCY, retries=BATCH_RETRIES):
+    """
+    Answer `questions` ([(id, question)]) writing one JSON line per answer to `out`.
+
+    Retrieval runs in batches of BATCH_RETRIEVAL_SIZE on a worker thread while earlier
+    questions are already with the LLM; at most `concurrency` LLM calls are in flight.
+
+    Returns:
+        dict: answered, failed, seconds and questions_per_min.
+    """
+    slots = asyncio.Semaphore(concurrency)
+    tasks = []
+    counts = {"answered": 0, "failed": 0}
+    start = time.perf_counter()
+
+    async def answer(question_id, question, docs):
+        asked = time.perf_counter()
+        result = {"id": question_id, "question": question}
+        try:
+            result["sources"] = [{"source": doc.metadata.get("source"), "page": source_page(doc)} for doc in docs]
+            messages = ai.prompt.format_messages(context=ai.format_docs(docs), history="（无）", question=question)
+            result["answer"], result["attempts"] = await ask(ai.llm, messages, retries)
+            counts["answered"] += 1
+        except Exception as e:
+            result["error"] = str(e)
+            counts["failed"] += 1
+        finally:
+            slots.release()
+        result["seconds"] = round(time.perf_counter() - asked, 3)
+        # Tasks share one event loop thread, so lines are never interleaved.
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+        done = counts["answered"] + counts["failed"]
+        if done % 10 == 0 or done == len(questions):
+            print(f"已完成 {done}/{len(questions)}（失败 {counts['failed']}）")
+
+    with ai.answering():
+        for offset in range(0, len(questions), BATCH_RETRIEVAL_SIZE):
+            batch = questions[offset:offset + BATCH_RETRIEVAL_SIZE]
+            retrieved = await asyncio.to_thread(ai.retrieve_many, [question for _, question in batch])
+            for (question_id, question), docs in zip(batch, retrieved):
+                # Taking the slot here keeps retrieval from running arbitrarily far ahead of the LLM.
+                await slots.acquire()
+                tasks.append(asyncio.create_task(answer(question_id, question, docs)))
+        await asyncio.gather(*tasks)
+
+    seconds = time.perf_counter() - start
+    return dict(counts, seconds=round(seconds, 3),
+                questions_per_min=round(len(questions) * 60 / seconds, 2) if seconds else 0.0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("input", help="questions as .jsonl, or plain text with one question per line")
+    parser.add_argument("-o", "--output", default="answers.jsonl")
+    parser.add_argument("-c", "--concurrency", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES)
+    args = parser.parse_args()
+
+    questions = read_questions(args.input)
+    if not questions:
+        print("输入文件中没有问题。")
+        return
+
+    from main import PriestessAI
+
+    ai = PriestessAI()
+    if not ai.vectorstore or not ai.llm:
+        sys.exit("普瑞赛斯似乎还没准备好...")
+
+    print(f"共 {len(questions)} 个问题，并发 {args.concurrency}，结果写入 {args.output}")
+    with open(args.output, "w", encoding="utf-8") as out:
+        summary = asyncio.run(answer_all(ai, questions, out, max(1, args.concurrency), args.retries))
+    print(f"完成 {summary['answered']} 个，失败 {summary['failed']} 个，"
+          f"用时 {summary['seconds']:.1f} 秒，{summary['questions_per_min']:.1f} 题/分钟。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+"""
+End-to-end benchmark: ingestion stages, retrieval latency, time-to-first-token and formula
+rendering, run offline against a synthetic corpus and a local stand-in for the LLM API.
+
+    python benchmark.py --files-per-type 5 --file-kb 20 --queries 10 --output bench.json
+
+    python benchmark.py --skip-ingest --skip-chat --vector-rows 100000   # Chroma vs. the mmap index
+
+Everything is written to a temporary working directory, so the real chroma_db, data/ and
+caches are untouched. The embedding model has to be in the local Hugging Face cache already.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# No network on the benchmark box: fail fast instead of retrying downloads.
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ZH_TERMS = ["矩阵", "特征值", "特征向量", "梯度下降", "概率分布", "条件概率", "贝叶斯", "卷积",
+            "正则化", "损失函数", "反向传播", "傅里叶变换", "拉格朗日乘子", "协方差", "极大似然"]
+EN_TERMS = ["matrix", "eigenvalue", "gradient", "descent", "probability", "distribution", "kernel",
+            "vector", "loss", "function", "convolution", "regularization", "entropy", "variance",
+            "likelihood", "optimizer", "tensor", "derivative", "integral", "bayes"]
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"mean": sum(ordered) / len(ordered), "p50": pick(0.5), "p95": pick(0.95), "max": ordered[-1]}
+
+# --- synthetic corpus ---------------------------------------------------------------
+
+def sentence(rng, terms):
+    return " ".join(rng.choice(terms) for _ in range(rng.randint(6, 18))) + "."
+
+def paragraph_text(rng, size, terms):
+    parts, length = [], 0
+    while length < size:
+        text = " ".join(sentence(rng, terms) for _ in range(rng.randint(3, 6)))
+        parts.append(text)
+        length += len(text) + 2
+    return "\n\n".join(parts)
+
+def write_pdf(path, lines, lines_per_page=50):
+    """Minimal single-font PDF, enough for PyPDFLoader; built by hand so no PDF library is needed."""
+    escape = lambda s: s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page in pages:
+        stream = "BT /F1 9 Tf 12 TL 40 760 Td " + " ".join(f"({escape(line)}) Tj T*" for line in page) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append((
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode("latin-1"))
+        page_ids.append(len(objects))
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode("latin-1")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+def generate_corpus(directory, files_per_type=5, file_kb=20, seed=0):
+    """Write files_per_type each of .txt, .md, .py and .pdf files of about file_kb KB into directory."""
+    rng = random.Random(seed)
+    mixed = ZH_TERMS + EN_TERMS
+    size = file_kb * 1024
+    os.makedirs(directory, exist_ok=True)
+    for i in range(files_per_type):
+        with open(os.path.join(directory, f"notes_{i}.txt"), "w", encoding="utf-8") as f:
+            f.write(paragraph_text(rng, size // 2, mixed))  # CJK characters are 3 bytes in UTF-8
+        with open(os.path.join(directory, f"lecture_{i}.md"), "w", encoding="utf-8") as f:
+            sections = [f"## {rng.choice(ZH_TERMS)} {j}\n\n{paragraph_text(rng, 2000, mixed)}\n\n$$ a_{j}^2 + b^2 = c^2 $$"
+                        for j in range(max(1, size // 4000))]
+            f.write(f"# 第 {i} 讲\n\n" + "\n\n".join(sections))
+        with open(os.path.join(directory, f"example_{i}.py"), "w", encoding="utf-8") as f:
+            blocks = []
+            while sum(map(len, blocks)) < size:
+                name = f"{rng.choice(EN_TERMS)}_{len(blocks)}"
+                blocks.append(f'def {name}(x):\n    """{sentence(rng, EN_TERMS)}"""\n    return x * {rng.randint(1, 9)}\n')
+            f.write("\n\n".join(blocks))
+        lines = []
+        while sum(map(len, lines)) < size:
+            lines.append(sentence(rng, EN_TERMS)[:100])
+        write_pdf(os.path.join(directory, f"slides_{i}.pdf"), lines)
+
+def sample_queries(count, seed=1):
+    rng = random.Random(seed)
+    templates = ["什么是{}？", "{}和{}有什么关系？", "请解释 {} 的定义", "how does {} relate to {}?"]
+    queries = []
+    for _ in range(count):
+        template = rng.choice(templates)
+        terms = EN_TERMS if template.isascii() else ZH_TERMS
+        queries.append(template.format(*(rng.choice(terms) for _ in range(template.count("{}")))))
+    return queries
+
+# --- stand-in LLM API -----------------------------------------------------------------
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    """Answers /chat/completions like an OpenAI-compatible endpoint, streaming canned tokens with fixed delays."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server
+        tokens = ["博士", "，", "这段", "记录", "说明", "了", " $E=mc^2$ ", "的", "含义", "。"] * (server.answer_tokens // 10 or 1)
+        time.sleep(server.first_token_delay)
+
+        if not request.get("stream"):
+            body = json.dumps({
+                "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": request.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i, token in enumerate(tokens + [None]):
+                if i:
+                    time.sleep(server.token_delay)
+                delta = {"content": token} if token is not None else {}
+                if i == 0:
+                    delta["role"] = "assistant"
+                chunk = {
+                    "id": "bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if token is not None else "stop"}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def start_fake_llm(first_token_delay=0.05, token_delay=0.01, answer_tokens=100):
+    """Start the stand-in API on a free local port; returns the server, whose base URL is server.base_url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeLLMHandler)
+    server.daemon_threads = True
+    server.first_token_delay = first_token_delay
+    server.token_delay = token_delay
+    server.answer_tokens = answer_tokens
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, name="fake-llm", daemon=True).start()
+    return server
+
+# --- stages ---------------------------------------------------------------------------
+
+class PrecomputedEmbeddings:
+    """Hands back vectors computed earlier, so the write stage is timed without embedding."""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+def bench_ingest(data_dir, work_dir):
+    """Time load, split, embed and write one after another on a single core, then the real pipeline end to end."""
+    import ingest
+    from lexical_index import LexicalIndex
+    from embedding_engine import EmbeddingEngine
+    from vector_store import VECTOR_BACKEND, open_vector_store
+
+    files = sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir))
+    results = {"files": len(files), "bytes": sum(os.path.getsize(path) for path in files)}
+
+    start = time.perf_counter()
+    loaded = [ingest.load_file(path) for path in files]
+    results["load_sec"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    splitter = ingest.make_text_splitter()
+    chunks = [chunk for docs in loaded for chunk in splitter.split_documents(docs)]
+    results["split_sec"] = time.perf_counter() - start
+    results["chunks"] = len(chunks)
+
+    texts = [chunk.page_content for chunk in chunks]
+    engine = EmbeddingEngine(ingest.EMBEDDING_MODEL)
+    start = time.perf_counter()
+    vectors = engine.embed_documents(texts)
+    results["embed_sec"] = time.perf_counter() - start
+    results["embed_chunks_per_sec"] = len(texts) / results["embed_sec"] if results["embed_sec"] else 0.0
+
+    # The configured backend (VECTOR_BACKEND), in a directory of its own so the pipeline run starts empty.
+    store = open_vector_store(PrecomputedEmbeddings(dict(zip(texts, vectors))), os.path.join(work_dir, "stage_db"))
+    results["vector_backend"] = VECTOR_BACKEND
+    lexical = LexicalIndex(os.path.join(work_dir, "stage_lexical.sqlite"))
+    ids = [f"bench-{i}" for i in range(len(chunks))]
+    start = time.perf_counter()
+    for i in range(0, len(chunks), ingest.WRITE_BATCH_SIZE):
+        store.add_documents(chunks[i:i + ingest.WRITE_BATCH_SIZE], ids=ids[i:i + ingest.WRITE_BATCH_SIZE])
+        lexical.add(ids[i:i + ingest.WRITE_BATCH_SIZE], chunks[i:i + ingest.WRITE_BATCH_SIZE])
+    results["write_sec"] = time.perf_counter() - start
+
+    # The real pipeline (parallel parsing, embedding cache, manifest) into the working directory's vector store.
+    start = time.perf_counter()
+    ingest.create_vector_db()
+    results["pipeline_sec"] = time.perf_counter() - start
+    return results
+
+def bench_chat(queries, llm_server):
+    """Retrieval latency (cold and cached) and time-to-first-token through PriestessAI.chat."""
+    # Only the fake server: an LLM_ENDPOINTS list from .env would send prompts to the real APIs.
+    os.environ["LLM_ENDPOINTS"] = ""
+    os.environ["LLM_MODEL"] = "benchmark"
+    os.environ["BASE_URL"] = llm_server.base_url
+    os.environ["API_KEY"] = "benchmark"
+    # sample_queries may repeat a question; neither a cached answer nor history may shorten its TTFT.
+    os.environ["ANSWER_CACHE"] = "0"
+    os.environ["CONVERSATION_MEMORY"] = "0"
+    from main import PriestessAI
+
+    start = time.perf_counter()
+    ai = PriestessAI()
+    results = {"startup_sec": time.perf_counter() - start}
+
+    cold, warm, stages = [], [], {}
+    for query in queries:
+        ai.retrieval_cache.clear()
+        ai.query_embedding_cache.clear()
+        # Repeated questions would otherwise find their embedding in the on-disk cache.
+        ai.embeddings.cache.clear("query")
+        start = time.perf_counter()
+        _, timings = ai.retrieve_timed(query)
+        cold.append(time.perf_counter() - start)
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+        start = time.perf_counter()
+        ai.retrieve(query)
+        warm.append(time.perf_counter() - start)
+    results["retrieval_cold_sec"] = percentiles(cold)
+    results["retrieval_cached_sec"] = percentiles(warm)
+    results["retrieval_stages_sec"] = {stage: percentiles(values) for stage, values in stages.items()}
+
+    first_token, total, rates = [], [], []
+    for i, query in enumerate(queries):
+        ai.retrieval_cache.clear()
+        # A fresh session per question, so every one goes through the same path.
+        start = time.perf_counter()
+        pieces = 0
+        for _ in ai.chat(query, session_id=f"bench-{i}"):
+            if pieces == 0:
+                first_token.append(time.perf_counter() - start)
+            pieces += 1
+        elapsed = time.perf_counter() - start
+        total.append(elapsed)
+        if pieces and elapsed > first_token[-1]:
+            rates.append(pieces / (elapsed - first_token[-1]))
+    results["time_to_first_token_sec"] = percentiles(first_token)
+    results["answer_sec"] = percentiles(total)
+    results["chunks_per_sec"] = percentiles(rates)
+    results["llm_first_token_delay_sec"] = llm_server.first_token_delay
+    return results
+
+def bench_formulas(rounds=3):
+    import text_renderer
+    return {name + "_renders_per_sec": rate
+            for name, rate in text_renderer.benchmark(text_renderer.BENCHMARK_FORMULAS * 4, rounds).items()}
+
+def directory_bytes(path):
+    return sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(path) for name in names)
+
+def bench_vector_backends(work_dir, rows, dim, queries=50, k=5):
+    """Open time, search latency and recall@k of Chroma against the mmap index on random unit vectors."""
+    import numpy as np
+    from langchain_chroma import Chroma
+    from vector_store import MmapVectorStore
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((rows, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Queries near stored rows, so the exact top-k is well separated from the rest.
+    probes = vectors[rng.choice(rows, queries, replace=False)] + rng.standard_normal((queries, dim), dtype=np.float32) * 0.05
+    probes /= np.linalg.norm(probes, axis=1, keepdims=True)
+    exact = [set(np.argsort(-(vectors @ probe))[:k].tolist()) for probe in probes]
+    ids = [str(i) for i in range(rows)]
+    texts = [f"chunk {i}" for i in range(rows)]
+
+    def build_chroma(path):
+        store = Chroma(persist_directory=path, collection_metadata={"hnsw:space": "cosine"})
+        for i in range(0, rows, 5000):
+            store._collection.add(ids=ids[i:i + 5000], embeddings=vectors[i:i + 5000].tolist(),
+                                  documents=texts[i:i + 5000])
+
+    def build_mmap(path, dtype):
+        store = MmapVectorStore(path, dtype=dtype)
+        for i in range(0, rows, 5000):
+            store.add_vectors(vectors[i:i + 5000], texts[i:i + 5000], [{}] * len(texts[i:i + 5000]), ids[i:i + 5000])
+
+    backends = {
+        "chroma": (build_chroma, lambda path: Chroma(persist_directory=path, collection_metadata={"hnsw:space": "cosine"})),
+        "mmap_float16": (lambda path: build_mmap(path, "float16"), lambda path: MmapVectorStore(path)),
+        "mmap_int8": (lambda path: build_mmap(path, "int8"), lambda path: MmapVectorStore(path)),
+    }
+    results = {"rows": rows, "dim": dim, "k": k}
+    for name, (build, reopen) in backends.items():
+        path = os.path.join(work_dir, "vectors_" + name)
+        start = time.perf_counter()
+        build(path)
+        build_sec = time.perf_counter() - start
+
+        start = time.perf_counter()
+        store = reopen(path)
+        open_sec = time.perf_counter() - start
+
+        latencies, hits = [], 0
+        for probe, truth in zip(probes, exact):
+            start = time.perf_counter()
+            docs = store.similarity_search_by_vector(probe.tolist(), k=k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(truth & {int(doc.id) for doc in docs})
+        results[name] = {
+            "build_sec": build_sec,
+            "open_sec": open_sec,
+            "search_sec": percentiles(latencies),
+            "recall_at_k": hits / (k * queries),
+            "disk_bytes": directory_bytes(path),
+        }
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args):
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "config": vars(args),
+    }
+    work_dir = tempfile.mkdtemp(prefix="priestess-bench-")
+    previous_dir = os.getcwd()
+    sys.path.insert(0, REPO_DIR)
+    # Every path used by ingest.py and PriestessAI is relative, so they all land in work_dir.
+    os.chdir(work_dir)
+    try:
+        generate_corpus(os.path.join(work_dir, "data"), args.files_per_type, args.file_kb)
+        if not args.skip_ingest:
+            print("基准测试：导入阶段...")
+            results["ingest"] = bench_ingest(os.path.join(work_dir, "data"), work_dir)
+        if not args.skip_chat:
+            if args.skip_ingest:
+                import ingest
+                ingest.create_vector_db()
+            print("基准测试：检索与首字延迟...")
+            server = start_fake_llm(args.first_token_delay, args.token_delay, args.answer_tokens)
+            try:
+                results["chat"] = bench_chat(sample_queries(args.queries), server)
+            finally:
+                server.shutdown()
+        if not args.skip_formulas:
+            print("基准测试：公式渲染...")
+            results["formulas"] = bench_formulas()
+        if args.vector_rows:
+            print("基准测试：向量后端...")
+            results["vector_backends"] = bench_vector_backends(work_dir, args.vector_rows, args.vector_dim)
+    finally:
+        os.chdir(previous_dir)
+        if args.keep:
+            print(f"工作目录保留在 {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files-per-type", type=int, default=5)
+    parser.add_argument("--file-kb", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--first-token-delay", type=float, default=0.05, help="seconds the fake LLM waits before its first token")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--skip-ingest", action="store_true")
+    parser.add_argument("--skip-chat", action="store_true")
+    parser.add_argument("--skip-formulas", action="store_true")
+    parser.add_argument("--vector-rows", type=int, default=0, help="compare vector backends on this many random vectors; 0 skips it")
+    parser.add_argument("--vector-dim", type=int, default=1024)
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    results = run(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import json
+import tempfile
+
+class ChatHistory:
+    """
+    Append-only archive of finished exchanges, kept in a temporary file.
+
+    Only the byte offset of each exchange stays in memory, so the chat window can drop
+    old turns from its document and read them back when the user scrolls up.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.offsets = []
+
+    def append(self, question, answer, cancelled=False):
+        record = {"question": question, "answer": answer, "cancelled": cancelled}
+        self.file.seek(0, os.SEEK_END)
+        self.offsets.append(self.file.tell())
+        self.file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        return len(self.offsets) - 1
+
+    def load(self, start, stop):
+        """Exchanges start..stop-1 as dicts with question, answer and cancelled."""
+        if start >= stop:
+            return []
+        self.file.seek(self.offsets[start])
+        return [json.loads(self.file.readline()) for _ in range(start, stop)]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.file.close()
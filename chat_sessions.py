@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+class ChatRequest:
+    """Handle for one in-flight answer; cancel() stops generation and closes the LLM stream."""
+
+    def __init__(self, session_id, loop):
+        self.session_id = session_id
+        self.loop = loop
+        # Only touched on the loop thread.
+        self.task = None
+        self.cancelled = False
+        self.finished = threading.Event()
+
+    def cancel(self):
+        self.loop.call_soon_threadsafe(self._cancel)
+
+    def _cancel(self):
+        self.cancelled = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def done(self):
+        return self.finished.is_set()
+
+class ChatSessionManager:
+    """
+    Serves several conversations at once from one asyncio event loop on a background thread.
+
+    Each session has at most one answer in flight: submitting a new question to a busy
+    session cancels the previous one. The session id also selects the conversation memory.
+    Callbacks are invoked on the loop thread, so GUI callers should forward them through
+    thread-safe signals.
+    """
+
+    def __init__(self, ai):
+        self.ai = ai
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="priestess-chat-loop", daemon=True)
+        self.thread.start()
+        self.active = {}
+        self.lock = threading.Lock()
+
+    def submit(self, session_id, query, on_chunk, on_done):
+        """
+        Start answering `query` in `session_id`.
+
+        Args:
+            on_chunk (callable): Called with each streamed text piece.
+            on_done (callable): Called once with True if the request was cancelled, else False.
+
+        Returns:
+            ChatRequest: Handle used to cancel the request.
+        """
+        with self.lock:
+            previous = self.active.get(session_id)
+            if previous is not None:
+                previous.cancel()
+            request = ChatRequest(session_id, self.loop)
+            self.active[session_id] = request
+        self.loop.call_soon_threadsafe(self._start, request, query, on_chunk, on_done)
+        return request
+
+    def _start(self, request, query, on_chunk, on_done):
+        if request.cancelled:
+            self._finish(request, on_done, True)
+            return
+        request.task = self.loop.create_task(self._run(request.session_id, query, on_chunk))
+        # The task's own done-callback, not a cancelled future's: on_done fires only once the
+        # coroutine has unwound, so no chunk can arrive after it.
+        request.task.add_done_callback(lambda task: self._finish(request, on_done, task.cancelled()))
+
+    def cancel(self, session_id):
+        with self.lock:
+            request = self.active.get(session_id)
+        if request is not None:
+            request.cancel()
+
+    def _finish(self, request, on_done, cancelled):
+        with self.lock:
+            if self.active.get(request.session_id) is request:
+                del self.active[request.session_id]
+        request.finished.set()
+        on_done(cancelled)
+
+    async def _run(self, session_id, query, on_chunk):
+        try:
+            async for chunk in self.ai.achat(query, session_id=session_id):
+                on_chunk(chunk)
+        except Exception as e:
+            on_chunk(f"\n[连接出错：{e}]")
+
+    def close(self):
+        for request in list(self.active.values()):
+            request.cancel()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=5)
@@ -0,0 +1,142 @@
+import os
+import re
+
+# The persona prompt cites sources from these headers; keep the format in sync with PERSONA_PROMPT.
+HEADER_TEMPLATE = "--- [来源: {source} 第 {page} 页] ---\n"
+
+# Suffix/prefix overlap accepted as "same text" when chunks carry no start_index (splitter chunk_overlap is 50).
+MIN_TEXT_OVERLAP = 10
+MAX_TEXT_OVERLAP = 200
+NEAR_DUPLICATE_THRESHOLD = 0.8
+SHINGLE_SIZE = 5
+
+_CJK_PATTERN = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+def estimate_tokens(text):
+    """Fallback token count when the model tokenizer is unavailable: one per CJK character, ~4 chars otherwise."""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def load_token_counter(tokenizer_name):
+    """Return a count_tokens(text) callable for a Hugging Face tokenizer, or the estimate if it cannot load."""
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+    except Exception as e:
+        print(f"无法加载分词器 {tokenizer_name}，将按字符估算 token 数: {e}")
+        return estimate_tokens
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+class _Block:
+    def __init__(self, rank, doc):
+        self.rank = rank
+        self.source = doc.metadata.get('source', '未知文件')
+        self.page = doc.metadata.get('page', 0)
+        self.start = doc.metadata.get('start_index')
+        self.text = doc.page_content
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+    def try_merge(self, other):
+        """Absorb `other` if it overlaps or directly follows/precedes this block on the same page."""
+        if (self.source, self.page) != (other.source, other.page):
+            return False
+        if self.start is not None and other.start is not None:
+            first, second = (self, other) if self.start <= other.start else (other, self)
+            if second.start > first.end:
+                return False
+            text = first.text + second.text[first.end - second.start:] if second.end > first.end else first.text
+            self.start, self.text = first.start, text
+        else:
+            merged = _merge_by_text(self.text, other.text) or _merge_by_text(other.text, self.text)
+            if merged is None:
+                return False
+            self.text = merged
+        self.rank = min(self.rank, other.rank)
+        return True
+
+def _merge_by_text(first, second):
+    if second in first:
+        return first
+    for size in range(min(len(first), len(second), MAX_TEXT_OVERLAP), MIN_TEXT_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return None
+
+def _shingles(text):
+    text = "".join(text.split())
+    return {text[i:i + SHINGLE_SIZE] for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))}
+
+def truncate_to_tokens(text, budget, count_tokens):
+    """Longest prefix of text that fits in `budget` tokens."""
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if count_tokens(text[:mid]) <= budget:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+def build_context(docs, token_budget, count_tokens=estimate_tokens):
+    """
+    Pack retrieved chunks into the prompt context.
+
+    Chunks from the same source page that overlap or touch are merged, near-duplicate
+    blocks (shingle Jaccard >= NEAR_DUPLICATE_THRESHOLD) are dropped, and blocks are added
+    in relevance order until `token_budget` is used. A block that no longer fits is
+    truncated if at least a quarter of it fits, otherwise skipped.
+
+    Args:
+        docs (list): Retrieved documents, most relevant first.
+        token_budget (int): Maximum tokens for the whole context, headers included.
+        count_tokens (callable): Token counter for the target model.
+
+    Returns:
+        str: The context string with one citation header per block.
+    """
+    blocks = []
+    for rank, doc in enumerate(docs):
+        block = _Block(rank, doc)
+        # Merging can make a block touch one it previously did not, so keep absorbing until stable.
+        merged = True
+        while merged:
+            merged = False
+            for existing in blocks:
+                if existing.try_merge(block):
+                    blocks.remove(existing)
+                    block = existing
+                    merged = True
+                    break
+        blocks.append(block)
+    blocks.sort(key=lambda b: b.rank)
+
+    kept = []
+    kept_shingles = []
+    for block in blocks:
+        shingles = _shingles(block.text)
+        if any(len(shingles & other) / len(shingles | other) >= NEAR_DUPLICATE_THRESHOLD for other in kept_shingles):
+            continue
+        kept.append(block)
+        kept_shingles.append(shingles)
+
+    parts = []
+    remaining = token_budget
+    for block in kept:
+        header = HEADER_TEMPLATE.format(source=os.path.basename(block.source), page=block.page + 1)
+        text = block.text.replace("\n", " ")
+        content = text + "\n"
+        available = remaining - count_tokens(header)
+        if available <= 0:
+            break
+        needed = count_tokens(content)
+        if needed > available:
+            if available * 4 < needed:
+                continue
+            content = truncate_to_tokens(text, available - count_tokens("\n"), count_tokens) + "\n"
+            needed = count_tokens(content)
+        parts.append(header + content)
+        remaining -= count_tokens(header) + needed
+    return "".join(parts)
@@ -0,0 +1,163 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from context_builder import estimate_tokens, truncate_to_tokens
+
+# Most recent exchanges quoted verbatim in the prompt; older ones are folded into a summary.
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", 3))
+# Upper bound on the conversation-history part of the prompt (summary + verbatim turns).
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", 800))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", 300))
+
+# Seconds the rewrite may hold up retrieval; past that the question is searched as asked.
+MEMORY_REWRITE_TIMEOUT = float(os.getenv("MEMORY_REWRITE_TIMEOUT", 2.0))
+
+# A rewrite costs a full LLM round trip before retrieval, so only questions that clearly
+# lean on earlier turns get one: short ones opening with a pronoun or discourse marker
+# ("那它的复杂度呢？", "what about the inverse?"), or bare ones like "为什么？".
+_FOLLOW_UP_PATTERN = re.compile(
+    r"^\s*(?:那么|那个|那|这个|这些|这|它们|它|其|此|上面|上述|刚才|之前|前面|然后|还有|继续|再|另外"
+    r"|(?:and|so|then|what about|how about|it|this|that|these|those|they)\b)",
+    re.IGNORECASE,
+)
+_SHORT_QUESTION = 20
+_BARE_QUESTION = 6
+
+_rewrite_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="priestess-rewrite")
+
+def is_follow_up(question):
+    question = question.strip()
+    if len(question) <= _BARE_QUESTION:
+        return True
+    # English needs about twice the characters of Chinese for the same question.
+    limit = _SHORT_QUESTION * 2 if question.isascii() else _SHORT_QUESTION
+    return len(question) <= limit and bool(_FOLLOW_UP_PATTERN.match(question))
+
+REWRITE_PROMPT = """根据下面的对话，把博士的最新问题改写成一个不依赖上下文、可以单独用于检索资料的完整问题。
+只输出改写后的问题，不要回答它。
+
+{history}
+
+最新问题：{question}
+"""
+
+SUMMARY_PROMPT = """把下面的对话要点压缩成一段不超过 {limit} 字的摘要，保留讨论过的概念、公式和结论，供后续对话参考。
+只输出摘要。
+
+已有摘要：
+{summary}
+
+新增对话：
+{turns}
+"""
+
+def format_turns(turns):
+    return "\n".join(f"博士：{question}\n普瑞赛斯：{answer}" for question, answer in turns)
+
+class ConversationMemory:
+    """
+    Memory of one chat session.
+
+    The last `recent_turns` exchanges are kept verbatim; older ones are folded into a
+    rolling summary by a background job after an answer finishes, so summarizing never
+    delays the next answer. history() always fits in `token_budget` tokens.
+
+    Args:
+        llm: Chat model used for rewriting and summarizing (anything with invoke()).
+        executor: Where summarization jobs run.
+        count_tokens (callable): Token counter for the chat model.
+    """
+
+    def __init__(self, llm, executor, count_tokens=estimate_tokens, recent_turns=MEMORY_RECENT_TURNS,
+                 token_budget=MEMORY_TOKEN_BUDGET, summary_tokens=MEMORY_SUMMARY_TOKENS):
+        self.llm = llm
+        self.executor = executor
+        self.count_tokens = count_tokens
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.turns = []
+        self.summary = ""
+        self.summarizing = False
+        self.lock = threading.Lock()
+
+    def history(self):
+        """Summary plus as many of the newest exchanges as fit the token budget, oldest first."""
+        with self.lock:
+            summary, turns = self.summary, list(self.turns)
+
+        parts = []
+        remaining = self.token_budget
+        if summary:
+            block = f"（更早的对话摘要）{summary}"
+            parts.append(block)
+            remaining -= self.count_tokens(block)
+        recent = []
+        for question, answer in reversed(turns):
+            block = format_turns([(question, answer)])
+            needed = self.count_tokens(block)
+            if needed > remaining:
+                # The newest exchange matters most: keep a cut-down version rather than nothing.
+                if not recent and remaining > 0:
+                    recent.append(truncate_to_tokens(block, remaining, self.count_tokens))
+                break
+            recent.append(block)
+            remaining -= needed
+        parts.extend(reversed(recent))
+        return "\n".join(parts)
+
+    def standalone_question(self, question):
+        """
+        The question rewritten to stand on its own for retrieval; unchanged when it already
+        does, or when the rewrite takes longer than MEMORY_REWRITE_TIMEOUT.
+        """
+        with self.lock:
+            has_history = bool(self.turns or self.summary)
+        if not has_history or not is_follow_up(question):
+            return question
+        prompt = REWRITE_PROMPT.format(history=self.history(), question=question)
+        future = _rewrite_pool.submit(self.llm.invoke, prompt)
+        try:
+            rewritten = future.result(timeout=MEMORY_REWRITE_TIMEOUT).content.strip()
+        except FutureTimeout:
+            print("问题改写超时，按原问题检索。")
+            return question
+        except Exception as e:
+            print(f"问题改写失败，按原问题检索: {e}")
+            return question
+        return rewritten or question
+
+    def add_turn(self, question, answer):
+        with self.lock:
+            self.turns.append((question, answer))
+        self._schedule_summary()
+
+    def _schedule_summary(self):
+        with self.lock:
+            if self.summarizing or len(self.turns) <= self.recent_turns:
+                return
+            self.summarizing = True
+            old_turns = self.turns[:len(self.turns) - self.recent_turns]
+            summary = self.summary
+        self.executor.submit(self._summarize, summary, old_turns)
+
+    def _summarize(self, summary, old_turns):
+        try:
+            prompt = SUMMARY_PROMPT.format(
+                limit=self.summary_tokens, summary=summary or "（无）", turns=format_turns(old_turns)
+            )
+            new_summary = self.llm.invoke(prompt).content.strip()
+            new_summary = truncate_to_tokens(new_summary, self.summary_tokens, self.count_tokens)
+        except Exception as e:
+            print(f"对话摘要失败: {e}")
+            with self.lock:
+                self.summarizing = False
+            return
+        with self.lock:
+            # Turns are only ever appended, so the summarized ones are still at the front.
+            del self.turns[:len(old_turns)]
+            self.summary = new_summary
+            self.summarizing = False
+        # More turns may have arrived while this one ran.
+        self._schedule_summary()
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import hashlib
+import threading
+from array import array
+from langchain_core.embeddings import Embeddings
+
+# Lives outside chroma_db on purpose: wiping the vector store must not throw away the embeddings.
+EMBEDDING_CACHE_PATH = "./embedding_cache.sqlite"
+
+# SQLite's default limit on bound parameters is 999.
+_LOOKUP_BATCH = 500
+
+def text_key(text):
+    return hashlib.sha256(text.encode("utf-8")).digest()
+
+class EmbeddingCache:
+    """
+    On-disk store of embedding vectors keyed by (model, kind, sha256(text)).
+
+    `kind` separates document and query embeddings, since a model may encode them differently.
+    Vectors are stored as raw float32 blobs.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, kind TEXT NOT NULL, text_hash BLOB NOT NULL, vector BLOB NOT NULL,"
+            " PRIMARY KEY (model, kind, text_hash)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def get_many(self, model, kind, keys):
+        found = {}
+        keys = list(set(keys))
+        with self.lock:
+            for i in range(0, len(keys), _LOOKUP_BATCH):
+                batch = keys[i:i + _LOOKUP_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self.conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings"
+                    f" WHERE model = ? AND kind = ? AND text_hash IN ({placeholders})",
+                    [model, kind, *batch],
+                )
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, model, kind, items):
+        rows = [(model, kind, key, array("f", vector).tobytes()) for key, vector in items]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, kind, text_hash, vector) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.commit()
+
+    def clear(self, kind=None):
+        """Drop cached vectors of one kind ("doc" or "query"), or all of them."""
+        with self.lock:
+            if kind is None:
+                self.conn.execute("DELETE FROM embeddings")
+            else:
+                self.conn.execute("DELETE FROM embeddings WHERE kind = ?", (kind,))
+            self.conn.commit()
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings implementation so identical texts are only ever embedded once per model."""
+
+    def __init__(self, embeddings, model_name, cache=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        keys = [text_key(t) for t in texts]
+        vectors = self.cache.get_many(self.model_name, "doc", keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), new_vectors))
+            self.cache.put_many(self.model_name, "doc", new_items)
+            vectors.update(new_items)
+
+        return [list(vectors[key]) for key in keys]
+
+    def embed_query(self, text):
+        key = text_key(text)
+        cached = self.cache.get_many(self.model_name, "query", [key])
+        if key in cached:
+            self.hits += 1
+            return cached[key]
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many(self.model_name, "query", [(key, vector)])
+        return list(vector)
+
+    def embed_queries(self, texts):
+        """embed_query for many texts, computing the uncached ones in a single batch."""
+        keys = [text_key(t) for t in texts]
+        vectors = self.cache.get_many(self.model_name, "query", keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors:
+                missing.setdefault(key, text)
+
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            # Queries and documents go through the same encoder; only the cache namespace differs.
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), new_vectors))
+            self.cache.put_many(self.model_name, "query", new_items)
+            vectors.update(new_items)
+
+        return [list(vectors[key]) for key in keys]
+
+def cached_embeddings(embeddings, model_name, path=EMBEDDING_CACHE_PATH):
+    """Return `embeddings` backed by the shared on-disk cache at `path`."""
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return CachedEmbeddings(embeddings, model_name, EmbeddingCache(path))
@@ -0,0 +1,126 @@
+import os
+import time
+from langchain_core.embeddings import Embeddings
+from embedding_cache import cached_embeddings
+
+EMBEDDING_MODEL = "BAAI/bge-m3"
+
+# Tunables, overridable from the environment (or .env):
+#   EMBED_BATCH_SIZE  texts per forward pass
+#   EMBED_THREADS     torch intra-op threads, 0 keeps torch's default
+#   EMBED_MODE        fp32 | fp16 (GPU only) | int8 (dynamic quantization, CPU) | onnx (ONNX Runtime)
+#   EMBED_DEVICE      cpu | cuda | empty for auto
+DEFAULT_BATCH_SIZE = 32
+EMBED_MODES = ("fp32", "fp16", "int8", "onnx")
+
+class EmbeddingEngine(Embeddings):
+    """
+    SentenceTransformer-backed embeddings with explicit batching and precision control.
+
+    Inputs are sorted by length before batching so each batch pads to similar lengths,
+    and results are returned in the original order. Throughput of every call is
+    accumulated in `total_chunks` / `total_seconds`.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL, batch_size=None, threads=None, mode=None, device=None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        self.model_name = model_name
+        self.batch_size = batch_size or int(os.getenv("EMBED_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        self.threads = threads if threads is not None else int(os.getenv("EMBED_THREADS", 0))
+        self.mode = (mode or os.getenv("EMBED_MODE", "fp32")).lower()
+        self.device = device or os.getenv("EMBED_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+
+        if self.mode not in EMBED_MODES:
+            raise ValueError(f"Unknown EMBED_MODE {self.mode!r}, expected one of {EMBED_MODES}")
+
+        if self.threads > 0:
+            torch.set_num_threads(self.threads)
+
+        if self.mode == "fp16" and self.device == "cpu":
+            print("fp16 嵌入需要 GPU，已回退为 fp32。")
+            self.mode = "fp32"
+
+        if self.mode == "onnx":
+            self.model = SentenceTransformer(model_name, device=self.device, backend="onnx")
+        else:
+            self.model = SentenceTransformer(model_name, device=self.device)
+            if self.mode == "fp16":
+                self.model.half()
+            elif self.mode == "int8":
+                self.model.to("cpu")
+                self.device = "cpu"
+                self.model = torch.quantization.quantize_dynamic(
+                    self.model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+
+        self.total_chunks = 0
+        self.total_seconds = 0.0
+
+    def _encode(self, texts):
+        start = time.perf_counter()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for i in range(0, len(order), self.batch_size):
+            batch = order[i:i + self.batch_size]
+            encoded = self.model.encode(
+                [texts[j] for j in batch],
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
+            for j, vector in zip(batch, encoded):
+                vectors[j] = vector.tolist()
+        self.total_chunks += len(texts)
+        self.total_seconds += time.perf_counter() - start
+        return vectors
+
+    def embed_documents(self, texts):
+        return self._encode([t.replace("\n", " ") for t in texts])
+
+    def embed_query(self, text):
+        return self._encode([text.replace("\n", " ")])[0]
+
+    @property
+    def cache_namespace(self):
+        """
+        Key of this encoder in the embedding cache. fp16, int8 and ONNX produce different
+        vectors from fp32, so each gets its own namespace; fp32 keeps the bare model name
+        that existing caches were written under.
+        """
+        return self.model_name if self.mode == "fp32" else f"{self.model_name}:{self.mode}"
+
+    def throughput(self):
+        """Chunks per second over every call so far."""
+        if not self.total_seconds:
+            return 0.0
+        return self.total_chunks / self.total_seconds
+
+def build_embeddings(model_name=EMBEDDING_MODEL, **kwargs):
+    """The embedding backend shared by ingest.py and PriestessAI: EmbeddingEngine behind the on-disk cache."""
+    engine = EmbeddingEngine(model_name, **kwargs)
+    return cached_embeddings(engine, engine.cache_namespace)
+
+def benchmark(texts, **kwargs):
+    """Compare the previous default HuggingFaceEmbeddings path with EmbeddingEngine, in chunks/sec."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    baseline = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    start = time.perf_counter()
+    baseline.embed_documents(texts)
+    baseline_rate = len(texts) / (time.perf_counter() - start)
+
+    engine = EmbeddingEngine(EMBEDDING_MODEL, **kwargs)
+    engine.embed_documents(texts)
+
+    return {"baseline": baseline_rate, engine.mode: engine.throughput()}
+
+if __name__ == "__main__":
+    import random
+
+    random.seed(0)
+    words = ["矩阵", "特征值", "gradient", "descent", "概率", "分布", "kernel", "向量", "loss", "函数"]
+    sample = [" ".join(random.choice(words) for _ in range(random.randint(10, 200))) for _ in range(256)]
+    for name, rate in benchmark(sample).items():
+        print(f"{name}: {rate:.1f} chunks/sec")
@@ -1,17 +1,38 @@
 import os
-import shutil  
+import shutil
 import json
 import glob
+import time
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader, TextLoader, UnstructuredMarkdownLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+from embedding_engine import build_embeddings
+from lexical_index import LexicalIndex, LEXICAL_INDEX_PATH
+from vector_store import open_vector_store, MMAP_COMPACT_RATIO
+from tracing import span, traced
+from dotenv import load_dotenv
+
+load_dotenv()
 
 DATA_PATH = "./data"
 DB_PATH = "./chroma_db"
+MANIFEST_PATH = ".ingest_manifest.json"
+# Flat list of ingested paths written by older versions; migrated into the manifest on first run.
 PROCESSED_RECORD_PATH = ".processed_files"
 EMBEDDING_MODEL = "BAAI/bge-m3"
 
+PARSE_WORKERS = os.cpu_count() or 1
+# Parsed-but-not-yet-embedded files held at once; bounds peak memory independently of corpus size.
+MAX_PENDING_FILES = PARSE_WORKERS * 2
+WRITE_BATCH_SIZE = 64
+# While the caller reports a chat in progress, each write batch waits up to this many seconds
+# before embedding, so a long ingestion in the same process does not slow the answer down.
+INGEST_YIELD_MAX = float(os.getenv("INGEST_YIELD_MAX", 10.0))
+_YIELD_POLL = 0.1
+
 LOADERS = {
     ".pdf": PyPDFLoader,
     ".txt": TextLoader,
@@ -19,81 +40,351 @@ LOADERS = {
     ".py": TextLoader
 }
 
-def load_processed_files():
-    if os.path.exists(PROCESSED_RECORD_PATH):
+# Manifest layout:
+#   files:    {path: {"sha256", "size", "mtime"}}  -- every file currently in DATA_PATH
+#   contents: {sha256: {"source", "ids"}}          -- every distinct content in the vector store
+# Identical files share one "contents" entry, so a renamed or re-dropped copy is never embedded twice,
+# and chunks are only deleted once no file references their content any more.
+
+def empty_manifest():
+    return {"version": 1, "files": {}, "contents": {}}
+
+def load_manifest():
+    if os.path.exists(MANIFEST_PATH):
+        try:
+            with open(MANIFEST_PATH, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get("version") == 1:
+                return manifest
+        except Exception:
+            pass
+    return empty_manifest()
+
+def save_manifest(manifest):
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def chunk_ids(sha, count):
+    # Deterministic IDs make a re-run after an interrupted ingest an idempotent upsert.
+    return [f"{sha}-{i}" for i in range(count)]
+
+def scan_data_files():
+    all_files = set()
+    for ext in LOADERS.keys():
+        for f in glob.glob(os.path.join(DATA_PATH, f"**/*{ext}"), recursive=True):
+            all_files.add(os.path.relpath(os.path.abspath(f), os.getcwd()))
+    return all_files
+
+def expand_changed_paths(manifest, paths):
+    """
+    Normalize paths reported as changed into manifest keys: supported files among them,
+    files under any directory among them, and known files at or under a path that is gone.
+    """
+    changed = set()
+    for path in paths:
+        path = os.path.relpath(os.path.abspath(path), os.getcwd())
+        if os.path.isdir(path):
+            for ext in LOADERS.keys():
+                for f in glob.glob(os.path.join(path, f"**/*{ext}"), recursive=True):
+                    changed.add(os.path.relpath(os.path.abspath(f), os.getcwd()))
+        elif os.path.splitext(path)[1].lower() in LOADERS:
+            changed.add(path)
+        prefix = path + os.sep
+        changed.update(p for p in manifest["files"] if p.startswith(prefix))
+    return changed
+
+def scan_file_states(manifest, current_files):
+    """Return {path: entry} for the current files, hashing only those whose size or mtime changed."""
+    known = manifest["files"]
+    states = {}
+    for path in current_files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entry = known.get(path)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime_ns:
+            states[path] = entry
+            continue
         try:
-            with open(PROCESSED_RECORD_PATH, 'r') as f:
-                return set(json.load(f))
-        except:
-            return set()
-    return set()
+            sha = file_sha256(path)
+        except OSError as e:
+            print(f"读取文件 {path} 失败: {e}")
+            continue
+        states[path] = {"sha256": sha, "size": st.st_size, "mtime": st.st_mtime_ns}
+    return states
+
+def migrate_legacy_record(manifest, vectorstore):
+    """Adopt chunks recorded by the old `.processed_files` list so they can be tracked and deleted."""
+    try:
+        with open(PROCESSED_RECORD_PATH, 'r') as f:
+            legacy_files = json.load(f)
+    except Exception:
+        legacy_files = []
+
+    for path in legacy_files:
+        ids = vectorstore.get(where={"source": os.path.abspath(path)}, include=[])["ids"]
+        if not ids:
+            continue
+        if os.path.exists(path):
+            st = os.stat(path)
+            sha = file_sha256(path)
+            manifest["files"][path] = {"sha256": sha, "size": st.st_size, "mtime": st.st_mtime_ns}
+        else:
+            # Deleted since it was ingested: key it by path so the next diff removes its chunks.
+            sha = "legacy:" + path
+        entry = manifest["contents"].setdefault(sha, {"source": path, "ids": []})
+        entry["ids"].extend(ids)
+
+    os.remove(PROCESSED_RECORD_PATH)
+    print(f"已迁移旧版记录，共 {len(legacy_files)} 个文件。")
+
+def load_file(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    loader_cls = LOADERS[ext]
+    return loader_cls(file_path).load()
+
+def make_text_splitter():
+    # start_index lets the prompt builder merge overlapping neighbours back into one passage.
+    return RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50, add_start_index=True)
+
+def load_and_split(file_path):
+    """Parse one file and split it into chunks; runs inside the parse worker processes."""
+    return make_text_splitter().split_documents(load_file(file_path))
+
+def iter_split_files(pending):
+    """
+    Yield (sha, file_path, splits) as files finish parsing.
+
+    Parsing and splitting run in a process pool while the caller embeds; at most
+    MAX_PENDING_FILES files are submitted or waiting to be consumed at any time.
+    """
+    items = iter(pending.items())
+
+    if len(pending) == 1 or PARSE_WORKERS == 1:
+        for sha, file_path in items:
+            try:
+                yield sha, file_path, load_and_split(file_path)
+            except Exception as e:
+                print(f"加载文件 {file_path} 失败: {e}")
+        return
+
+    # spawn, not fork: the parent may already hold torch/Qt threads that must not be forked.
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=ctx) as pool:
+        in_flight = {}
+
+        def submit_next():
+            for sha, file_path in items:
+                in_flight[pool.submit(load_and_split, file_path)] = (sha, file_path)
+                return
 
-def save_processed_files(processed_files):
-    with open(PROCESSED_RECORD_PATH, 'w') as f:
-        json.dump(list(processed_files), f)
+        for _ in range(MAX_PENDING_FILES):
+            submit_next()
 
-def create_vector_db():
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                sha, file_path = in_flight.pop(future)
+                submit_next()
+                try:
+                    splits = future.result()
+                except Exception as e:
+                    print(f"加载文件 {file_path} 失败: {e}")
+                    continue
+                yield sha, file_path, splits
+
+class ChunkWriter:
+    """Buffers chunks from many files and writes them to the vector store in fixed-size batches."""
+
+    def __init__(self, manifest, open_vectorstore, lexical_index, batch_size=WRITE_BATCH_SIZE, on_update=None,
+                 is_busy=None):
+        self.manifest = manifest
+        self.open_vectorstore = open_vectorstore
+        self.lexical_index = lexical_index
+        self.batch_size = batch_size
+        self.on_update = on_update
+        self.is_busy = is_busy
+        self.vectorstore = None
+        self.docs = []
+        self.ids = []
+        # Files whose last chunk is in the buffer; recorded in the manifest once it is flushed.
+        self.completed = []
+        self.written = 0
+
+    def add_file(self, sha, file_path, splits):
+        ids = chunk_ids(sha, len(splits))
+        for doc, chunk_id in zip(splits, ids):
+            self.docs.append(doc)
+            self.ids.append(chunk_id)
+            if len(self.docs) >= self.batch_size:
+                self.flush()
+        self.completed.append((sha, {"source": file_path, "ids": ids}))
+        if not self.docs:
+            self.flush()
+
+    def yield_to_chats(self):
+        if self.is_busy is None:
+            return
+        deadline = time.monotonic() + INGEST_YIELD_MAX
+        while self.is_busy() and time.monotonic() < deadline:
+            time.sleep(_YIELD_POLL)
+
+    def flush(self):
+        if self.docs:
+            with span("ingest.yield"):
+                self.yield_to_chats()
+            if self.vectorstore is None:
+                print("正在写入记忆库...")
+                self.vectorstore = self.open_vectorstore()
+            # Embedding happens inside add_documents, so this span covers embed + vector store write.
+            with span("ingest.flush", chunks=len(self.docs)):
+                self.vectorstore.add_documents(documents=self.docs, ids=self.ids)
+            with span("ingest.lexical", chunks=len(self.docs)):
+                self.lexical_index.add(self.ids, self.docs)
+            self.written += len(self.docs)
+            self.docs = []
+            self.ids = []
+            if self.on_update:
+                self.on_update()
+        if self.completed:
+            self.manifest["contents"].update(self.completed)
+            self.completed = []
+            # Checkpoint so an interrupted run resumes from the files already written.
+            save_manifest(self.manifest)
+
+def backfill_lexical_index(lexical_index, page_size=500):
+    """Index chunks that were written to the vector store before the lexical index existed."""
+    from langchain_core.documents import Document
+
+    vectorstore = open_vector_store()
+    offset = 0
+    while True:
+        batch = vectorstore.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+        if not batch["ids"]:
+            break
+        docs = [Document(page_content=text, metadata=metadata or {})
+                for text, metadata in zip(batch["documents"], batch["metadatas"])]
+        lexical_index.add(batch["ids"], docs)
+        offset += len(batch["ids"])
+    print(f"已为 {offset} 个已有知识块建立关键词索引。")
+
+@traced("ingest")
+def create_vector_db(vectorstore=None, lexical_index=None, progress=None, on_update=None, paths=None, is_busy=None):
+    """
+    Bring the vector store and lexical index in line with DATA_PATH.
+
+    Args:
+        vectorstore: An open vector store to write through, e.g. the one a running PriestessAI
+            searches; when None one is opened here with a freshly loaded embedding model.
+        lexical_index: The LexicalIndex to update alongside it; opened here when None.
+        progress (callable): Called after each file with a dict of files_done, files_total,
+            chunks and chunks_per_sec.
+        on_update (callable): Called whenever chunks were added or removed, so a live reader
+            can drop caches that may now be stale.
+        paths (iterable): Only re-examine these files or directories (e.g. from a file watcher)
+            instead of scanning all of DATA_PATH; everything else keeps its manifest state.
+        is_busy (callable): Returns True while a chat is being answered in this process; each
+            write batch then waits for it, up to INGEST_YIELD_MAX seconds.
+    """
     if not os.path.exists(DATA_PATH):
         os.makedirs(DATA_PATH)
         print(f"文件夹不存在，已创建 {DATA_PATH}。")
         return
 
-    processed_files = load_processed_files()
-    
-    all_files = []
-    for ext in LOADERS.keys():
-        all_files.extend(glob.glob(os.path.join(DATA_PATH, f"**/*{ext}"), recursive=True))
-    
-    all_files = set(all_files)
-    
-    all_files_abs = {os.path.abspath(f) for f in all_files}
-    processed_files_abs = {os.path.abspath(f) for f in processed_files}
-    
-    new_files = list(all_files_abs - processed_files_abs)
-    
-    if not new_files:
+    manifest = load_manifest()
+
+    if os.path.exists(PROCESSED_RECORD_PATH) and not os.path.exists(MANIFEST_PATH):
+        migrate_legacy_record(manifest, Chroma(persist_directory=DB_PATH))
+        save_manifest(manifest)
+
+    if lexical_index is None:
+        lexical_index = LexicalIndex(LEXICAL_INDEX_PATH)
+    if manifest["contents"] and lexical_index.count() == 0:
+        backfill_lexical_index(lexical_index)
+
+    with span("ingest.scan"):
+        if paths is None:
+            states = scan_file_states(manifest, scan_data_files())
+        else:
+            changed = expand_changed_paths(manifest, paths)
+            states = {p: e for p, e in manifest["files"].items() if p not in changed}
+            states.update(scan_file_states(manifest, {p for p in changed if os.path.isfile(p)}))
+
+    live_contents = {}
+    for path, entry in sorted(states.items()):
+        live_contents.setdefault(entry["sha256"], path)
+
+    stale = [sha for sha in manifest["contents"] if sha not in live_contents]
+    pending = {sha: path for sha, path in live_contents.items() if sha not in manifest["contents"]}
+
+    if not stale and not pending:
+        if states != manifest["files"]:
+            manifest["files"] = states
+            save_manifest(manifest)
         print("没有检测到新文件。")
         return
-        
-    print(f"检测到 {len(new_files)} 个新文件，开始处理...")
-    
-    docs = []
-    for file_path in new_files:
-        try:
-            ext = os.path.splitext(file_path)[1].lower()
-            if ext in LOADERS:
-                loader_cls = LOADERS[ext]
-                loader = loader_cls(file_path)
-                docs.extend(loader.load())
-            else:
-                print(f"Skipping unsupported file: {file_path}")
-        except Exception as e:
-            print(f"加载文件 {file_path} 失败: {e}")
-
-    if not docs:
-        print("新文件无法解析或内容为空。")
-        return
-        
-    print(f"共加载 {len(docs)} 页新文档。")
-
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    splits = text_splitter.split_documents(docs)
-    print(f"切分完成，本次新增 {len(splits)} 个知识块。")
-
-    print("正在写入记忆库...")
-    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-    
-    vectorstore = Chroma(
-        persist_directory=DB_PATH, 
-        embedding_function=embeddings
-    )
-    
-    vectorstore.add_documents(documents=splits)
-    
+
+    print(f"检测到 {len(pending)} 个新增或修改的文件，{len(stale)} 份过期内容，开始处理...")
+
+    def open_vectorstore():
+        if vectorstore is not None:
+            return vectorstore
+        return open_vector_store(build_embeddings(EMBEDDING_MODEL))
+
+    writer = ChunkWriter(manifest, open_vectorstore, lexical_index, on_update=on_update, is_busy=is_busy)
+    if pending:
+        start = time.perf_counter()
+        for files_done, (sha, file_path, splits) in enumerate(iter_split_files(pending), start=1):
+            writer.add_file(sha, file_path, splits)
+            if progress:
+                elapsed = time.perf_counter() - start
+                progress({
+                    "files_done": files_done,
+                    "files_total": len(pending),
+                    "chunks": writer.written,
+                    "chunks_per_sec": writer.written / elapsed if elapsed else 0.0,
+                })
+        writer.flush()
+        print(f"切分完成，本次新增 {writer.written} 个知识块。")
+        embeddings = writer.vectorstore.embeddings if writer.vectorstore is not None else None
+        if hasattr(embeddings, "hits"):
+            print(f"嵌入缓存命中 {embeddings.hits} 个，新计算 {embeddings.misses} 个，"
+                  f"模型速度 {embeddings.embeddings.throughput():.1f} 块/秒。")
+
+    store = writer.vectorstore or vectorstore
+    if stale:
+        store = store or open_vector_store()
+        stale_ids = [i for sha in stale for i in manifest["contents"][sha]["ids"]]
+        if stale_ids:
+            with span("ingest.delete", chunks=len(stale_ids)):
+                store.delete(ids=stale_ids)
+                lexical_index.delete(stale_ids)
+            if on_update:
+                on_update()
+        for sha in stale:
+            del manifest["contents"][sha]
+        print(f"已清除 {len(stale_ids)} 个过期知识块。")
+
+    # Deleted and replaced chunks only leave tombstones in the mmap index; reclaim them in bulk.
+    if hasattr(store, "compact") and store.dead_ratio() > MMAP_COMPACT_RATIO:
+        with span("ingest.compact"):
+            store.compact()
+
+    # Files that failed to load stay out of the manifest so the next run retries them.
+    manifest["files"] = {p: e for p, e in states.items() if e["sha256"] in manifest["contents"]}
+    save_manifest(manifest)
+
     print(f"注入完成！数据库已更新。")
-    
-    processed_files_abs.update(new_files)
-    save_processed_files([os.path.relpath(f, os.getcwd()) for f in processed_files_abs])
 
 if __name__ == "__main__":
-    create_vector_db()
\ No newline at end of file
+    create_vector_db()
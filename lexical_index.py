@@ -0,0 +1,169 @@
+import re
+import json
+import math
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+
+# Kept next to chroma_db and updated by ingest.py with the same chunk IDs as the vector store.
+LEXICAL_INDEX_PATH = "./lexical_index.sqlite"
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Query terms found in more than this fraction of chunks are skipped: their IDF is near zero,
+# but scoring them means walking a posting list as long as the index. Small indexes score
+# every term.
+BM25_MAX_DF = 0.5
+BM25_MAX_DF_MIN_CHUNKS = 1000
+
+# SQLite's default limit on bound parameters is 999.
+_LOOKUP_BATCH = 500
+
+_TOKEN_PATTERN = re.compile(
+    r"[A-Za-z_][A-Za-z0-9_]*"        # words and code identifiers
+    r"|\d+(?:\.\d+)?"                # numbers
+    r"|[\u3400-\u9fff\uf900-\ufaff]+"  # runs of CJK characters
+    r"|[^\sA-Za-z0-9_]"              # any other single character, filtered below
+)
+
+def _is_cjk(text):
+    return "\u3400" <= text[0] <= "\u9fff" or "\uf900" <= text[0] <= "\ufaff"
+
+def tokenize(text, unigrams=True):
+    """
+    Split text into index terms.
+
+    ASCII words and identifiers are lowercased, with snake_case parts added as extra terms.
+    CJK runs become character unigrams and bigrams, which match Chinese words without a
+    segmentation dictionary. Math symbols and Greek letters are kept as single-character
+    terms; punctuation is dropped.
+
+    With unigrams=False (used for queries) a CJK run of two or more characters yields only
+    its bigrams, which already cover every character and have far shorter posting lists.
+    """
+    tokens = []
+    for token in _TOKEN_PATTERN.findall(text):
+        if _is_cjk(token):
+            if unigrams or len(token) == 1:
+                tokens.extend(token)
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        elif len(token) == 1 and not token.isalnum() and token != "_":
+            if unicodedata.category(token) in ("Sm", "So"):
+                tokens.append(token)
+        elif len(token) == 1 and not token.isascii():
+            tokens.append(token)
+        else:
+            token = token.lower()
+            tokens.append(token)
+            if "_" in token.strip("_"):
+                tokens.extend(part for part in token.split("_") if part)
+    return tokens
+
+class LexicalIndex:
+    """Persistent BM25 inverted index over chunks, updated incrementally by chunk ID."""
+
+    def __init__(self, path=LEXICAL_INDEX_PATH):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " chunk_id TEXT PRIMARY KEY, length INTEGER NOT NULL, content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, chunk_id)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id)")
+        self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def add(self, ids, docs):
+        chunk_rows = []
+        posting_rows = []
+        for chunk_id, doc in zip(ids, docs):
+            terms = Counter(tokenize(doc.page_content))
+            chunk_rows.append((chunk_id, sum(terms.values()), doc.page_content,
+                               json.dumps(doc.metadata, ensure_ascii=False)))
+            posting_rows.extend((term, chunk_id, tf) for term, tf in terms.items())
+        with self.lock:
+            self._delete(ids)
+            self.conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", chunk_rows)
+            self.conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", posting_rows)
+            self.conn.commit()
+
+    def delete(self, ids):
+        with self.lock:
+            self._delete(ids)
+            self.conn.commit()
+
+    def _delete(self, ids):
+        rows = [(chunk_id,) for chunk_id in ids]
+        self.conn.executemany("DELETE FROM postings WHERE chunk_id = ?", rows)
+        self.conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", rows)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM postings")
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.commit()
+
+    def search(self, query, k=5):
+        """Return up to k (chunk_id, score) pairs ranked by BM25."""
+        terms = list(set(tokenize(query, unigrams=False)))
+        if not terms:
+            return []
+        with self.lock:
+            n_docs, total_length = self.conn.execute("SELECT COUNT(*), TOTAL(length) FROM chunks").fetchone()
+            if not n_docs:
+                return []
+            avg_length = total_length / n_docs
+            # Document frequencies come from the (term, chunk_id) key alone, without reading postings.
+            df = dict(self._select_in("SELECT term, COUNT(*) FROM postings WHERE term IN ({}) GROUP BY term", terms))
+            if not df:
+                return []
+            limit = BM25_MAX_DF * n_docs if n_docs >= BM25_MAX_DF_MIN_CHUNKS else n_docs
+            selected = [term for term in df if df[term] <= limit] or [min(df, key=df.get)]
+            scores = Counter()
+            for term in selected:
+                postings = self.conn.execute(
+                    "SELECT p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c USING (chunk_id)"
+                    " WHERE p.term = ?",
+                    (term,),
+                )
+                idf = math.log(1 + (n_docs - df[term] + 0.5) / (df[term] + 0.5))
+                for chunk_id, tf, length in postings:
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[chunk_id] += idf * tf * (BM25_K1 + 1) / norm
+        return scores.most_common(k)
+
+    def get_documents(self, ids):
+        from langchain_core.documents import Document
+
+        with self.lock:
+            rows = {chunk_id: (content, metadata) for chunk_id, content, metadata in self._select_in(
+                "SELECT chunk_id, content, metadata FROM chunks WHERE chunk_id IN ({})", list(set(ids)))}
+        return [Document(id=chunk_id, page_content=rows[chunk_id][0], metadata=json.loads(rows[chunk_id][1]))
+                for chunk_id in ids if chunk_id in rows]
+
+    def _select_in(self, sql, values):
+        """Rows of `sql` with its IN ({}) list bound to `values`, in batches under the parameter limit."""
+        rows = []
+        for i in range(0, len(values), _LOOKUP_BATCH):
+            batch = values[i:i + _LOOKUP_BATCH]
+            rows.extend(self.conn.execute(sql.format(",".join("?" * len(batch))), batch))
+        return rows
+
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """Fuse several ranked lists of IDs; an ID scores sum(1 / (k + rank)) over the lists it appears in."""
+    scores = Counter()
+    for ranked in ranked_lists:
+        for rank, item in enumerate(ranked, start=1):
+            scores[item] += 1.0 / (k + rank)
+    return [item for item, _ in scores.most_common()]
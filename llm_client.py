@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen-flash")
+# Optional JSON list of endpoints tried in order, e.g.
+#   [{"base_url": "https://a/v1", "model": "qwen-flash"}, {"base_url": "https://b/v1", "model": "qwen-plus", "api_key": "..."}]
+# "api_key" defaults to API_KEY; when unset, BASE_URL + LLM_MODEL is the only endpoint.
+LLM_ENDPOINTS = os.getenv("LLM_ENDPOINTS", "")
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 0.3))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+# Seconds an endpoint may take to produce its first token, and to produce each token after that.
+LLM_FIRST_TOKEN_TIMEOUT = float(os.getenv("LLM_FIRST_TOKEN_TIMEOUT", 30))
+LLM_CHUNK_TIMEOUT = float(os.getenv("LLM_CHUNK_TIMEOUT", 20))
+# When > 0, the next endpoint is asked in parallel if the first token has not arrived after
+# this many seconds, and whichever answers first is used. 0 only fails over on errors.
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", 0))
+# Keep-alive pool per endpoint, shared by every chat, summary and batch request.
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+# A failed endpoint is moved to the back of the order for this many seconds.
+LLM_ENDPOINT_COOLDOWN = float(os.getenv("LLM_ENDPOINT_COOLDOWN", 30))
+LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", 200))
+
+def load_endpoints(api_key=None, base_url=None):
+    """Endpoint configs from LLM_ENDPOINTS, or the single BASE_URL/LLM_MODEL one."""
+    api_key = api_key or os.getenv("API_KEY")
+    base_url = base_url or os.getenv("BASE_URL")
+    configs = json.loads(LLM_ENDPOINTS) if LLM_ENDPOINTS.strip() else [{"base_url": base_url, "model": LLM_MODEL}]
+    return [Endpoint(config.get("name") or f"{config['model']}@{config.get('base_url') or 'default'}",
+                     config.get("base_url"), config["model"], config.get("api_key") or api_key)
+            for config in configs]
+
+class Endpoint:
+    """One base URL + model behind its own keep-alive connection pool, with its latency stats."""
+
+    def __init__(self, name, base_url, model, api_key):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.llm = None
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.wins = 0
+        self.first_token = deque(maxlen=LLM_STATS_WINDOW)
+        self.chunk_gaps = deque(maxlen=LLM_STATS_WINDOW)
+        self.last_error = None
+        self.cooldown_until = 0.0
+
+    def model_client(self):
+        if self.llm is None:
+            import httpx
+            from langchain_openai import ChatOpenAI
+
+            # The socket read timeout is only a backstop; first-token and inter-chunk limits
+            # are enforced per request by ManagedLLM.
+            timeout = httpx.Timeout(max(LLM_FIRST_TOKEN_TIMEOUT, LLM_CHUNK_TIMEOUT) + 5, connect=LLM_CONNECT_TIMEOUT)
+            limits = httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                  max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                                  keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+            self.llm = ChatOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                model=self.model,
+                temperature=LLM_TEMPERATURE,
+                streaming=True,
+                timeout=timeout,
+                # Retrying is ManagedLLM's job: a retry inside the SDK would hide a slow endpoint.
+                max_retries=0,
+                http_async_client=httpx.AsyncClient(timeout=timeout, limits=limits),
+            )
+        return self.llm
+
+    def failed(self, error):
+        self.errors += 1
+        if isinstance(error, TimeoutError):
+            self.timeouts += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        self.cooldown_until = time.monotonic() + LLM_ENDPOINT_COOLDOWN
+
+    def stats(self):
+        def pick(values, q):
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else None
+        return {
+            "model": self.model,
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "first_token_p50_ms": pick(self.first_token, 0.5),
+            "first_token_p95_ms": pick(self.first_token, 0.95),
+            "chunk_gap_p95_ms": pick(self.chunk_gaps, 0.95),
+            "cooling_down": time.monotonic() < self.cooldown_until,
+            "last_error": self.last_error,
+        }
+
+class EndpointsFailed(Exception):
+    """No endpoint produced a first token; `errors` is [(endpoint name, exception)] in the order they failed."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("all LLM endpoints failed: " + "; ".join(
+            f"{name}: {str(error) or type(error).__name__}" for name, error in errors))
+
+async def _next_content(stream, timeout):
+    """
+    The next chunk that carries text (role-only and empty chunks are skipped) within
+    `timeout` seconds, or None once the stream has ended.
+    """
+    async def pull():
+        async for chunk in stream:
+            if chunk.content:
+                return chunk
+        return None
+    try:
+        return await asyncio.wait_for(pull(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"no token within {timeout:g}s") from None
+
+async def _aclose(stream):
+    # A cancelled __anext__ may still be unwinding on the loop; close the stream once it has.
+    while stream.ag_running:
+        await asyncio.sleep(0)
+    await stream.aclose()
+
+class ManagedLLM:
+    """
+    Chat model front-end for PriestessAI: invoke/ainvoke/stream/astream over a list of
+    endpoints with first-token and inter-chunk timeouts, failover and optional hedging.
+
+    All HTTP traffic runs on one private event loop thread, so every caller (GUI session
+    loop, server threads, batch mode) shares the same keep-alive connections. An endpoint
+    is only switched before its first token; a failure after that is raised, since the
+    text already streamed cannot be taken back.
+    """
+
+    def __init__(self, endpoints=None):
+        self.endpoints = endpoints or load_endpoints()
+        self.loop = None
+        self.loop_lock = threading.Lock()
+
+    def _submit(self, coro):
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="priestess-llm", daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def ordered_endpoints(self):
+        # Stable sort: configured order, with endpoints that failed recently at the back.
+        now = time.monotonic()
+        return sorted(self.endpoints, key=lambda endpoint: endpoint.cooldown_until > now)
+
+    async def _open(self, endpoint, messages):
+        """
+        Start a stream on `endpoint` and wait for its first token: (stream, first chunk).
+        A completion without any text is a successful empty answer: (stream, None).
+        """
+        endpoint.requests += 1
+        start = time.perf_counter()
+        stream = endpoint.model_client().astream(messages)
+        try:
+            chunk = await _next_content(stream, LLM_FIRST_TOKEN_TIMEOUT)
+        except BaseException as e:
+            await stream.aclose()
+            if not isinstance(e, asyncio.CancelledError):
+                endpoint.failed(e)
+            raise
+        if chunk is not None:
+            endpoint.first_token.append(time.perf_counter() - start)
+        return stream, chunk
+
+    async def _race(self, messages):
+        """(endpoint, stream, first chunk) from the first endpoint to produce a token."""
+        candidates = self.ordered_endpoints()
+        attempts = {}
+        errors = []
+
+        def launch():
+            endpoint = candidates.pop(0)
+            attempts[asyncio.ensure_future(self._open(endpoint, messages))] = endpoint
+            return endpoint
+
+        launch()
+        try:
+            while attempts:
+                hedge = LLM_HEDGE_DELAY > 0 and candidates
+                done, _ = await asyncio.wait(attempts, timeout=LLM_HEDGE_DELAY if hedge else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch().hedges += 1
+                    continue
+                winner = None
+                for task in done:
+                    endpoint = attempts.pop(task)
+                    error = task.exception()
+                    if error is not None:
+                        errors.append((endpoint.name, error))
+                    elif winner is None:
+                        winner = (endpoint,) + task.result()
+                    else:
+                        await task.result()[0].aclose()
+                if winner is not None:
+                    winner[0].wins += 1
+                    return winner
+                if not attempts and candidates:
+                    launch()
+        finally:
+            # Losing or abandoned attempts: cancel them and close any stream that still got opened.
+            for task in attempts:
+                task.cancel()
+            for result in await asyncio.gather(*attempts, return_exceptions=True):
+                if isinstance(result, tuple):
+                    await result[0].aclose()
+        raise EndpointsFailed(errors)
+
+    async def _astream(self, messages):
+        endpoint, stream, chunk = await self._race(messages)
+        try:
+            while chunk is not None:
+                yield chunk
+                start = time.perf_counter()
+                try:
+                    chunk = await _next_content(stream, LLM_CHUNK_TIMEOUT)
+                except Exception as e:
+                    endpoint.failed(e)
+                    raise
+                if chunk is None:
+                    return
+                endpoint.chunk_gaps.append(time.perf_counter() - start)
+        finally:
+            await stream.aclose()
+
+    async def astream(self, messages):
+        """Yield message chunks with text; `messages` is anything ChatOpenAI accepts (str or messages)."""
+        stream = self._astream(messages)
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wrap_future(self._submit(stream.__anext__()))
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            await asyncio.wrap_future(self._submit(_aclose(stream)))
+
+    def stream(self, messages):
+        stream = self._astream(messages)
+        try:
+            while True:
+                try:
+                    chunk = self._submit(stream.__anext__()).result()
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            self._submit(_aclose(stream)).result()
+
+    async def ainvoke(self, messages):
+        from langchain_core.messages import AIMessage
+
+        parts = []
+        async for chunk in self.astream(messages):
+            parts.append(chunk.content)
+        return AIMessage(content="".join(parts))
+
+    def invoke(self, messages):
+        from langchain_core.messages import AIMessage
+
+        return AIMessage(content="".join(chunk.content for chunk in self.stream(messages)))
+
+    def stats(self):
+        """{endpoint name: request/error/timeout counts and first-token / inter-chunk latency}."""
+        return {endpoint.name: endpoint.stats() for endpoint in self.endpoints}
@@ -1,13 +1,53 @@
 import os
-from langchain_openai import ChatOpenAI
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from contextlib import aclosing, contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from query_cache import LRUCache, normalize_query
+from answer_cache import AnswerCache, context_fingerprint, replay
+from lexical_index import LexicalIndex, LEXICAL_INDEX_PATH, reciprocal_rank_fusion
+from context_builder import build_context, estimate_tokens, load_token_counter
+from conversation_memory import ConversationMemory, is_follow_up
+from tracing import span, record, isolated
+from vector_store import open_vector_store, vector_store_exists
+from llm_client import ManagedLLM, load_endpoints
+
+# LangChain, torch and Chroma are imported inside the methods that need them, so importing
+# this module (e.g. from pet.py) stays cheap and the heavy work can happen on a warm-up thread.
 
 load_dotenv()
 
+RETRIEVAL_K = 5
+# "hybrid" fuses BM25 keyword hits with vector hits; "vector" uses dense search alone.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Hits taken from each retriever before reciprocal rank fusion.
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+# Optional second stage: over-fetch RERANK_CANDIDATES chunks, keep the RETRIEVAL_K a cross-encoder scores best.
+RERANK = os.getenv("RERANK", "0") == "1"
+RERANK_MODEL = os.getenv("RERANK_MODEL", "BAAI/bge-reranker-base")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", 20))
+# Upper bound on retrieved-context tokens per prompt, counted with the chat model's tokenizer.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", "Qwen/Qwen2.5-7B-Instruct")
+# Query-side caches; QUERY_CACHE_TTL is in seconds, 0 disables expiry.
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 256))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", 0))
+# Opt-in reuse of answers to near-duplicate questions asked against the same retrieved chunks.
+ANSWER_CACHE = os.getenv("ANSWER_CACHE", "0") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+# Per-session conversation memory; MEMORY_SESSIONS bounds how many sessions are remembered.
+CONVERSATION_MEMORY = os.getenv("CONVERSATION_MEMORY", "1") == "1"
+MEMORY_SESSIONS = int(os.getenv("MEMORY_SESSIONS", 64))
+# The command-line chat's session; chat() without a session_id answers without memory.
+DEFAULT_SESSION = "default"
+# Written by ingest.py; its contents change whenever the knowledge base does.
+MANIFEST_PATH = ".ingest_manifest.json"
+
 PERSONA_PROMPT = """
 你现在是 普瑞赛斯。
 我是你的 博士。
@@ -28,6 +68,9 @@ PERSONA_PROMPT = """
     -   如果资料是英文，请自动在你的神经网路中翻译成简体中文讲给我听。
     -   引用格式：在回答的最后标注出处：【记录来源：文件名 第X页】，只有在找到答案时才引用，没找到时禁止引用。
 
+之前的对话：
+{history}
+
 已检索到的数据记录：
 {context}
 
@@ -35,77 +78,391 @@ PERSONA_PROMPT = """
 """
 
 class PriestessAI:
-    def __init__(self):
+    def __init__(self, background=False):
         self.api_key = os.getenv("API_KEY")
         self.base_url = os.getenv("BASE_URL")
-        self.db_path = "./chroma_db"
         self.embedding_model = "BAAI/bge-m3"
         self.llm = None
-        self.retriever = None
-        self.prompt = ChatPromptTemplate.from_template(PERSONA_PROMPT)
-        self.init_components()
-
+        self.vectorstore = None
+        self.lexical_index = None
+        self.reranker = None
+        self.ingest_lock = threading.Lock()
+        # Answers currently streaming; background ingestion waits while this is non-zero.
+        self.active_chats = 0
+        self.activity_lock = threading.Lock()
+        self.prompt = None
+        self.count_tokens = estimate_tokens
+        # Query embeddings depend only on the model; retrieval results also depend on the knowledge base.
+        self.query_embedding_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        self.retrieval_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+        self.memories = LRUCache(MEMORY_SESSIONS)
+        self.memory_lock = threading.Lock()
+        # Summaries are written here after an answer, never while one is being generated.
+        self.memory_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="priestess-memory")
+        self.answer_cache = None
+        if ANSWER_CACHE:
+            self.answer_cache = AnswerCache(
+                threshold=ANSWER_CACHE_THRESHOLD,
+                max_entries=ANSWER_CACHE_SIZE,
+                kb_version=self.knowledge_version(),
+            )
+        # Future resolved once init_components has run; None when it ran synchronously.
+        self.ready = None
+        if background:
+            warmup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="priestess-warmup")
+            self.ready = warmup.submit(self.init_components)
+            warmup.shutdown(wait=False)
+        else:
+            self.init_components()
 
+    def wait_until_ready(self, timeout=None):
+        """Block until background initialization finished; re-raises its exception if it failed."""
+        if self.ready is not None:
+            self.ready.result(timeout)
 
     def init_components(self):
-        self.embeddings = HuggingFaceEmbeddings(model_name=self.embedding_model)
+        from langchain_core.prompts import ChatPromptTemplate
+        from embedding_engine import build_embeddings
+
+        self.prompt = ChatPromptTemplate.from_template(PERSONA_PROMPT)
+        self.embeddings = build_embeddings(self.embedding_model)
+        self.count_tokens = load_token_counter(CONTEXT_TOKENIZER)
+        if RERANK:
+            from reranker import CrossEncoderReranker
+            self.reranker = CrossEncoderReranker(RERANK_MODEL)
         
-        if not os.path.exists(self.db_path):
+        if not vector_store_exists():
             print("错误：找不到数据库！请先运行 'python ingest.py' 导入课件。")
         else:
             self.load_vector_db()
 
-        self.llm = ChatOpenAI(
-            api_key=self.api_key, 
-            base_url=self.base_url,
-            model="qwen-flash", 
-            temperature=0.3,
-            streaming=True
-        )
+        self.llm = ManagedLLM(load_endpoints(self.api_key, self.base_url))
         print("普瑞赛斯已就位")
 
     def load_vector_db(self):
         print("普瑞赛斯正在读取记忆...")
-        vectorstore = Chroma(
-            persist_directory=self.db_path, 
-            embedding_function=self.embeddings
-        )
-        self.retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
+        self.vectorstore = open_vector_store(self.embeddings)
+        if RETRIEVAL_MODE == "hybrid" and os.path.exists(LEXICAL_INDEX_PATH):
+            self.lexical_index = LexicalIndex(LEXICAL_INDEX_PATH)
     
     def reload_knowledge(self):
+        self.wait_until_ready()
         print("正在热更新记忆库...")
-        self.retriever = None 
+        self.vectorstore = None 
+        self.invalidate_caches()
         self.load_vector_db()
         print("记忆库更新完毕！")
 
+    def invalidate_caches(self):
+        """Drop everything derived from the knowledge base; called whenever its contents change."""
+        self.retrieval_cache.clear()
+        if self.answer_cache:
+            # Evicts only answers from other versions, so an ingest that changed nothing keeps them.
+            self.answer_cache.set_kb_version(self.knowledge_version())
+
+    def ingest(self, progress=None, paths=None):
+        """
+        Run incremental ingestion inside this process.
+
+        Chunks are embedded with the already-loaded model and written through the open
+        Chroma collection and lexical index, so each batch is searchable as soon as it is
+        written and no reload is needed. `progress` and `paths` are passed on to
+        ingest.create_vector_db.
+        """
+        import ingest as ingestion
+
+        self.wait_until_ready()
+        with self.ingest_lock:
+            if self.vectorstore is None:
+                self.load_vector_db()
+            lexical_index = self.lexical_index or LexicalIndex(LEXICAL_INDEX_PATH)
+            ingestion.create_vector_db(
+                vectorstore=self.vectorstore,
+                lexical_index=lexical_index,
+                progress=progress,
+                on_update=self.invalidate_caches,
+                paths=paths,
+                is_busy=self.is_busy,
+            )
+            if RETRIEVAL_MODE == "hybrid":
+                self.lexical_index = lexical_index
+            self.invalidate_caches()
+
+    def is_busy(self):
+        return self.active_chats > 0
+
+    @contextmanager
+    def answering(self):
+        with self.activity_lock:
+            self.active_chats += 1
+        try:
+            yield
+        finally:
+            with self.activity_lock:
+                self.active_chats -= 1
+
+    def knowledge_version(self):
+        """Hash of the ingested contents; touching or re-scanning files leaves it unchanged."""
+        if not os.path.exists(MANIFEST_PATH):
+            return ""
+        try:
+            with open(MANIFEST_PATH, 'r', encoding='utf-8') as f:
+                contents = json.load(f).get("contents", {})
+        except ValueError:
+            return ""
+        return hashlib.sha256("\n".join(sorted(contents)).encode("utf-8")).hexdigest()
+
+    def embed_query(self, query):
+        key = normalize_query(query)
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(key)
+            self.query_embedding_cache.put(key, embedding)
+        return embedding
+
+    def embed_queries(self, queries):
+        """embed_query for many questions, with the uncached ones embedded in one batch."""
+        keys = [normalize_query(query) for query in queries]
+        embeddings = {key: self.query_embedding_cache.get(key) for key in keys}
+        missing = [key for key, embedding in embeddings.items() if embedding is None]
+        if missing:
+            if hasattr(self.embeddings, "embed_queries"):
+                vectors = self.embeddings.embed_queries(missing)
+            else:
+                vectors = self.embeddings.embed_documents(missing)
+            for key, embedding in zip(missing, vectors):
+                self.query_embedding_cache.put(key, embedding)
+                embeddings[key] = embedding
+        return [embeddings[key] for key in keys]
+
+    def search_vectors(self, embeddings, k):
+        """Dense top-k for each embedding; one vectorized pass when the backend supports it."""
+        if hasattr(self.vectorstore, "similarity_search_by_vectors"):
+            return self.vectorstore.similarity_search_by_vectors(embeddings, k=k)
+        return [self.vectorstore.similarity_search_by_vector(embedding, k=k) for embedding in embeddings]
+
+    def retrieve_many(self, queries):
+        """
+        retrieve() for a batch of questions: one embedding pass and one vector search for
+        all of them, then lexical fusion and reranking per question.
+        """
+        keys = [normalize_query(query) for query in queries]
+        results = {}
+        for key in keys:
+            docs = self.retrieval_cache.get(key)
+            if docs is not None:
+                results[key] = docs
+        missing = [key for key in dict.fromkeys(keys) if key not in results]
+        if missing:
+            with span("retrieve.batch", queries=len(missing)):
+                embeddings = self.embed_queries(missing)
+                candidates = RERANK_CANDIDATES if self.reranker else RETRIEVAL_K
+                fetch = candidates if self.lexical_index is None else max(candidates, HYBRID_CANDIDATES)
+                for key, embedding, vector_docs in zip(missing, embeddings, self.search_vectors(embeddings, fetch)):
+                    if self.lexical_index is None:
+                        docs = vector_docs[:candidates]
+                    else:
+                        docs = self.hybrid_search(key, embedding, candidates, vector_docs)
+                    if self.reranker:
+                        docs = self.reranker.rerank(key, docs, RETRIEVAL_K)
+                    self.retrieval_cache.put(key, docs)
+                    results[key] = docs
+        return [list(results[key]) for key in keys]
+
+    def retrieve(self, query):
+        """Top-k chunks for a question; repeated questions skip both the embedding pass and the search."""
+        return self.retrieve_timed(query)[0]
+
+    def retrieve_timed(self, query):
+        """(docs, {stage: seconds}) for this call alone, so concurrent callers each get their own timings."""
+        with span("retrieve"):
+            return self._retrieve(query)
+
+    def _retrieve(self, query):
+        key = normalize_query(query)
+        timings = {}
+        start = time.perf_counter()
+        docs = self.retrieval_cache.get(key)
+        if docs is None:
+            embedding = self.embed_query(key)
+            timings["embed"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            candidates = RERANK_CANDIDATES if self.reranker else RETRIEVAL_K
+            if self.lexical_index is None:
+                docs = self.vectorstore.similarity_search_by_vector(embedding, k=candidates)
+            else:
+                docs = self.hybrid_search(key, embedding, candidates)
+            timings["search"] = time.perf_counter() - start
+
+            if self.reranker:
+                start = time.perf_counter()
+                docs = self.reranker.rerank(key, docs, RETRIEVAL_K)
+                timings["rerank"] = time.perf_counter() - start
+
+            self.retrieval_cache.put(key, docs)
+        else:
+            timings["cache"] = time.perf_counter() - start
+        for stage, seconds in timings.items():
+            record(f"retrieve.{stage}", seconds)
+        return list(docs), timings
+
+    def hybrid_search(self, query, embedding, k, vector_docs=None):
+        if vector_docs is None:
+            vector_docs = self.vectorstore.similarity_search_by_vector(embedding, k=max(k, HYBRID_CANDIDATES))
+        lexical_ids = [chunk_id for chunk_id, _ in self.lexical_index.search(query, max(k, HYBRID_CANDIDATES))]
+
+        by_id = {doc.id: doc for doc in vector_docs}
+        fused = reciprocal_rank_fusion([[doc.id for doc in vector_docs], lexical_ids])[:k]
+        missing = [chunk_id for chunk_id in fused if chunk_id not in by_id]
+        by_id.update((doc.id, doc) for doc in self.lexical_index.get_documents(missing))
+        return [by_id[chunk_id] for chunk_id in fused if chunk_id in by_id]
+
     def format_docs(self, docs):
-        context_str = ""
-        for doc in docs:
-            source = os.path.basename(doc.metadata.get('source', '未知文件'))
-            page = doc.metadata.get('page', 0) + 1
-            content = doc.page_content.replace("\n", " ")
-            context_str += f"--- [来源: {source} 第 {page} 页] ---\n{content}\n"
-        return context_str
-
-    def chat(self, query):
-        if not self.retriever or not self.llm:
+        return build_context(docs, CONTEXT_TOKEN_BUDGET, self.count_tokens)
+
+    def memory_for(self, session_id):
+        if not CONVERSATION_MEMORY or not session_id:
+            return None
+        with self.memory_lock:
+            memory = self.memories.get(session_id)
+            if memory is None:
+                memory = ConversationMemory(self.llm, self.memory_executor, self.count_tokens)
+                self.memories.put(session_id, memory)
+        return memory
+
+    def prepare(self, query, session_id=None):
+        """
+        Everything before the LLM call: follow-up rewriting, retrieval, answer-cache lookup
+        and prompt inputs.
+
+        Returns (cached_answer, inputs, cache_key). When cached_answer is not None the
+        question can be answered without the LLM and the other two are None.
+        """
+        memory = self.memory_for(session_id)
+        # Follow-ups ("explain that further") are searched as the standalone question they stand for.
+        with span("chat.rewrite") as rewrite_span:
+            search_query = memory.standalone_question(query) if memory else query
+            rewrite_span.set(rewritten=search_query != query)
+        retrieved_docs = self.retrieve(search_query)
+        history = memory.history() if memory else ""
+
+        cache_key = None
+        # A follow-up only makes sense with this session's history, so its answer is neither
+        # replayed from nor stored for other sessions; self-contained questions use the cache.
+        if self.answer_cache and not (history and is_follow_up(query)):
+            cache_key = (self.embed_query(search_query), context_fingerprint(retrieved_docs))
+            cached = self.answer_cache.lookup(*cache_key)
+            if cached is not None:
+                return cached, None, None
+
+        with span("prompt.format"):
+            inputs = {
+                "context": self.format_docs(retrieved_docs),
+                "history": history or "（无）",
+                "question": query
+            }
+        return None, inputs, cache_key
+
+    def remember_answer(self, query, cache_key, answer_parts, session_id=None):
+        answer = "".join(answer_parts)
+        if not answer:
+            return
+        memory = self.memory_for(session_id)
+        if memory:
+            memory.add_turn(query, answer)
+        if self.answer_cache and cache_key:
+            embedding, fingerprint = cache_key
+            self.answer_cache.store(query, embedding, fingerprint, answer)
+
+    def chat(self, query, session_id=None):
+        # The spans below stay open across yields; isolated() keeps them in this stream's own context.
+        return isolated(self._chat(query, session_id))
+
+    def _chat(self, query, session_id=None):
+        try:
+            self.wait_until_ready()
+        except Exception as e:
+            yield f"普瑞赛斯未能苏醒：{e}"
+            return
+
+        if not self.vectorstore or not self.llm:
             yield "普瑞赛斯似乎还没准备好..."
             return
 
-        retrieved_docs = self.retriever.invoke(query)
-        context = self.format_docs(retrieved_docs)
-        
-        chain = self.prompt | self.llm
-        
-        for chunk in chain.stream({
-            "context": context, 
-            "question": query
-        }):
-            if chunk.content:
-                yield chunk.content
+        with span("chat") as chat_span:
+            cached, inputs, cache_key = self.prepare(query, session_id)
+            if cached is not None:
+                chat_span.set(answer_cache=True)
+                yield from replay(cached)
+                self.remember_answer(query, None, [cached], session_id)
+                return
+
+            messages = self.prompt.format_messages(**inputs)
+
+            answer_parts = []
+            with self.answering(), span("llm.stream") as stream_span:
+                start = time.perf_counter()
+                for chunk in self.llm.stream(messages):
+                    if chunk.content:
+                        if not answer_parts:
+                            record("llm.first_token", time.perf_counter() - start)
+                        answer_parts.append(chunk.content)
+                        yield chunk.content
+                stream_span.set(chunks=len(answer_parts))
+
+            # Only reached when the answer streamed to the end, so partial answers are never cached.
+            self.remember_answer(query, cache_key, answer_parts, session_id)
+
+    async def achat(self, query, session_id=None):
+        """
+        Async counterpart of chat().
+
+        Retrieval runs in a worker thread (the caches, BM25 lookup and reranker are
+        synchronous); the completion is streamed with astream. Cancelling the consuming
+        task closes the upstream HTTP stream.
+        """
+        try:
+            if self.ready is not None:
+                await asyncio.wrap_future(self.ready)
+        except Exception as e:
+            yield f"普瑞赛斯未能苏醒：{e}"
+            return
+
+        if not self.vectorstore or not self.llm:
+            yield "普瑞赛斯似乎还没准备好..."
+            return
+
+        with span("chat") as chat_span:
+            # to_thread copies the context, so spans opened by prepare() join this trace.
+            cached, inputs, cache_key = await asyncio.to_thread(self.prepare, query, session_id)
+            if cached is not None:
+                chat_span.set(answer_cache=True)
+                for piece in replay(cached):
+                    yield piece
+                self.remember_answer(query, None, [cached], session_id)
+                return
+
+            messages = self.prompt.format_messages(**inputs)
+
+            answer_parts = []
+            with self.answering(), span("llm.stream") as stream_span:
+                start = time.perf_counter()
+                async with aclosing(self.llm.astream(messages)) as stream:
+                    async for chunk in stream:
+                        if chunk.content:
+                            if not answer_parts:
+                                record("llm.first_token", time.perf_counter() - start)
+                            answer_parts.append(chunk.content)
+                            yield chunk.content
+                stream_span.set(chunks=len(answer_parts))
+
+            await asyncio.to_thread(self.remember_answer, query, cache_key, answer_parts, session_id)
 
 def main():
-    ai = PriestessAI()
+    from remote_client import create_ai
+
+    ai = create_ai()
     
     print("普瑞赛斯睁开了双眼...")
     
@@ -116,7 +473,7 @@ def main():
             
         print("\n 普瑞赛斯: ", end="", flush=True)
         
-        for content in ai.chat(query):
+        for content in ai.chat(query, session_id=DEFAULT_SESSION):
             print(content, end="", flush=True)
         
         print() 
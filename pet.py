@@ -1,31 +1,110 @@
+import time
+# Taken before the Qt imports so the reported time-to-first-paint covers interpreter startup work too.
+_START_TIME = time.perf_counter()
+
 import sys
-import threading
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QMenu, 
                              QAction, QWidget, QVBoxLayout, QTextEdit, 
-                             QLineEdit, QPushButton, QSystemTrayIcon, QListWidget, QMessageBox)
-from PyQt5.QtCore import Qt, QPoint, pyqtSignal, QObject, QThread
-from PyQt5.QtGui import QPixmap, QCursor, QIcon
-from main import PriestessAI
+                             QLineEdit, QPushButton, QSystemTrayIcon, QListWidget, QMessageBox,
+                             QGraphicsOpacityEffect, QTableWidget, QTableWidgetItem)
+from PyQt5.QtCore import Qt, QPoint, pyqtSignal, QObject, QThread, QTimer, QUrl
+from PyQt5.QtGui import QPixmap, QCursor, QIcon, QTextCursor, QTextDocument, QImage
+from remote_client import RemotePriestess, create_ai
+from watcher import DataWatcher
+from chat_sessions import ChatSessionManager
+from chat_history import ChatHistory
+import tracing
 import shutil
 import os
-import subprocess
-from text_renderer import process_text_with_formulas
+import base64
+import threading
+from collections import deque
+from text_renderer import (StreamingFormulaScanner, formula_img_tag, formula_key,
+                           render_formula_async, tokenize_formulas)
+
+# Streamed text reaches the chat view at most once per this many seconds (one frame at 60 Hz).
+CHAT_FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL", 1 / 60))
+# Exchanges kept in the chat view; older ones are archived to disk and read back when scrolling up.
+CHAT_HISTORY_TURNS = max(1, int(os.getenv("CHAT_HISTORY_TURNS", 40)))
+CHAT_HISTORY_LOAD_BATCH = int(os.getenv("CHAT_HISTORY_LOAD_BATCH", 10))
 
 class ChatWorker(QObject):
-    finished = pyqtSignal()
+    finished = pyqtSignal(bool)
     response_chunk = pyqtSignal(str)
+    # Internal hops from the session manager's event-loop thread to the GUI thread.
+    chunks_ready = pyqtSignal()
+    done = pyqtSignal(bool)
 
-    def __init__(self, ai, query):
+    def __init__(self, sessions, session_id, query):
         super().__init__()
-        self.ai = ai
+        self.sessions = sessions
+        self.session_id = session_id
         self.query = query
+        self.request = None
+        self.buffer = []
+        self.buffer_lock = threading.Lock()
+        self.flush_scheduled = False
+        self.last_flush = 0.0
+        self.started_at = None
+        self.chunks = 0
+        self.ui_updates = 0
+        # Set by stop(): text still in flight from the loop thread is dropped, not shown
+        # after the interrupt marker.
+        self.stopped = False
+        self.chunks_ready.connect(self.schedule_flush)
+        self.done.connect(self.on_done)
 
     def run(self):
-        for chunk in self.ai.chat(self.query):
-            self.response_chunk.emit(chunk)
-        self.finished.emit()
+        self.started_at = time.perf_counter()
+        self.request = self.sessions.submit(self.session_id, self.query, self.on_chunk, self.done.emit)
+
+    def on_chunk(self, text):
+        # Event-loop thread: tokens are buffered, and the GUI thread is only woken
+        # if no flush is already on its way.
+        with self.buffer_lock:
+            if self.stopped:
+                return
+            self.buffer.append(text)
+            self.chunks += 1
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.chunks_ready.emit()
+
+    def schedule_flush(self):
+        wait = self.last_flush + CHAT_FLUSH_INTERVAL - time.perf_counter()
+        if wait > 0:
+            QTimer.singleShot(int(wait * 1000) + 1, self.flush)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self.buffer_lock:
+            text = "".join(self.buffer)
+            self.buffer.clear()
+            self.flush_scheduled = False
+        if text and not self.stopped:
+            self.last_flush = time.perf_counter()
+            self.ui_updates += 1
+            self.response_chunk.emit(text)
+
+    def on_done(self, cancelled):
+        self.flush()
+        elapsed = time.perf_counter() - self.started_at
+        if elapsed > 0 and self.chunks:
+            print(f"本次回答 {self.chunks} 个片段，刷新界面 {self.ui_updates} 次"
+                  f"（{self.ui_updates / elapsed:.1f} 次/秒）")
+        self.finished.emit(cancelled)
+
+    def stop(self):
+        with self.buffer_lock:
+            self.stopped = True
+        if self.request is not None:
+            self.request.cancel()
 
 class ChatWindow(QWidget):
+    formula_rendered = pyqtSignal(int, str)
+
     def __init__(self, ai):
         super().__init__()
         self.ai = ai
@@ -37,6 +116,7 @@ class ChatWindow(QWidget):
 
         self.history_display = QTextEdit()
         self.history_display.setReadOnly(True)
+        self.history_display.verticalScrollBar().valueChanged.connect(self.on_history_scrolled)
         self.layout.addWidget(self.history_display)
 
         self.input_field = QLineEdit()
@@ -47,9 +127,31 @@ class ChatWindow(QWidget):
         self.send_btn = QPushButton("发送")
         self.send_btn.clicked.connect(self.send_message)
         self.layout.addWidget(self.send_btn)
+
+        self.stop_btn = QPushButton("停止")
+        self.stop_btn.clicked.connect(self.stop_message)
+        self.stop_btn.setDisabled(True)
+        self.layout.addWidget(self.stop_btn)
         
-        self.current_worker = None
-        self.current_response_text = ""
+        self.sessions = ChatSessionManager(ai)
+        self.session_id = "pet"
+        self.worker = None
+        self.formula_scanner = StreamingFormulaScanner()
+        # Formulas still rendering: job id -> (cursor selecting the formula's raw text, formula).
+        self.render_jobs = {}
+        self.next_render_job = 0
+        self.formula_rendered.connect(self.on_formula_rendered)
+        # Keys of formula images already registered as document resources; each is stored
+        # once and referenced by every <img> showing it.
+        self.formula_resources = set()
+
+        self.history = ChatHistory()
+        self.pending_question = None
+        # One cursor per displayed exchange, at the start of its first block; QTextCursors
+        # move with the text, so these stay valid as turns are trimmed or loaded above them.
+        self.exchange_starts = deque()
+        # History index of the first exchange still in the document.
+        self.first_exchange = 0
 
     def send_message(self):
         user_input = self.input_field.text().strip()
@@ -57,64 +159,189 @@ class ChatWindow(QWidget):
             return
 
         self.history_display.append(f"<b>博士:</b> {user_input}")
+        marker = QTextCursor(self.history_display.document())
+        marker.setPosition(self.history_display.document().lastBlock().position())
+        self.exchange_starts.append(marker)
+        self.pending_question = user_input
         self.input_field.clear()
         self.input_field.setDisabled(True)
 
         self.history_display.append("<b>普瑞赛斯:</b> ")
-        self.current_response_text = ""
+        self.formula_scanner = StreamingFormulaScanner()
 
-        self.worker = ChatWorker(self.ai, user_input)
+        self.worker = ChatWorker(self.sessions, self.session_id, user_input)
         
         self.worker.response_chunk.connect(self.update_response)
         self.worker.finished.connect(self.enable_input)
         
-        self.worker_thread = threading.Thread(target=self.worker.run)
-        self.worker_thread.start()
+        self.worker.run()
+        self.send_btn.setDisabled(True)
+        self.stop_btn.setDisabled(False)
+
+    def stop_message(self):
+        if self.worker is not None:
+            self.worker.stop()
 
     def update_response(self, text):
-        self.current_response_text += text
         cursor = self.history_display.textCursor()
         cursor.movePosition(cursor.End)
         cursor.insertText(text)
         self.history_display.setTextCursor(cursor)
         self.history_display.ensureCursorVisible()
-
-    def enable_input(self):
-        # Replace the raw streaming text with the processed HTML (with rendered formulas)
+        # Formulas whose closing delimiter just arrived start rendering while the rest streams in.
+        self.render_streamed_formulas(self.formula_scanner.feed(text), cursor.position())
+
+    def render_streamed_formulas(self, formulas, end):
+        """
+        Start rendering formulas completed in the answer being streamed.
+
+        `end` is the document position where the streamed answer currently ends. Formulas
+        arrive in order, so the text from the first new one onwards is still raw and every
+        span can be found by counting back from `end`.
+        """
+        streamed = self.formula_scanner.length
+        self.render_formulas([(end - (streamed - start), end - (streamed - stop), content)
+                              for start, stop, content in formulas])
+
+    def render_formulas(self, formulas):
+        """Start rendering (start, stop, formula) document spans and replace each one's raw text in place."""
+        if not formulas:
+            return
+        with tracing.span("formula.dispatch", formulas=len(formulas)):
+            self._render_formulas(formulas)
+
+    def _render_formulas(self, formulas):
+        spans = []
+        # Select all spans before replacing any: a replacement shifts the positions after it,
+        # while an existing QTextCursor moves with the text.
+        for start, stop, content in formulas:
+            span = QTextCursor(self.history_display.document())
+            span.setPosition(start)
+            span.setPosition(stop, QTextCursor.KeepAnchor)
+            spans.append((span, content))
+
+        for span, content in spans:
+            job = self.next_render_job
+            self.next_render_job += 1
+            b64 = render_formula_async(content, lambda b64, job=job: self.formula_rendered.emit(job, b64 or ""))
+            if b64:
+                self.insert_formula(span, content, b64)
+            else:
+                self.render_jobs[job] = (span, content)
+
+    def on_formula_rendered(self, job, b64):
+        span, content = self.render_jobs.pop(job, (None, None))
+        # A span whose turn was trimmed meanwhile has collapsed to an empty selection.
+        if span is not None and b64 and span.hasSelection():
+            self.insert_formula(span, content, b64)
+
+    def insert_formula(self, span, content, b64):
+        with tracing.span("formula.insert"):
+            self._insert_formula(span, content, b64)
+
+    def _insert_formula(self, span, content, b64):
+        key = formula_key(content)
+        if key not in self.formula_resources:
+            image = QImage.fromData(base64.b64decode(b64), "PNG")
+            self.history_display.document().addResource(QTextDocument.ImageResource, QUrl(f"formula:{key}"), image)
+            self.formula_resources.add(key)
+        span.insertHtml(formula_img_tag(f"formula:{key}"))
+
+    def enable_input(self, cancelled=False):
+        # A finished worker must never write into the next answer's text.
+        self.worker.response_chunk.disconnect(self.update_response)
         cursor = self.history_display.textCursor()
         cursor.movePosition(cursor.End)
-        # Select the length of the text we just streamed
-        # Note: We assume the cursor is at the end and the streaming text is the last thing added.
-        cursor.movePosition(cursor.Left, cursor.KeepAnchor, len(self.current_response_text))
-        cursor.removeSelectedText()
-        
-        # Process and insert HTML
-        processed_html = process_text_with_formulas(self.current_response_text)
-        cursor.insertHtml(processed_html)
+        end = cursor.position()
+        if cancelled:
+            cursor.insertHtml(" <i>（已中断）</i>")
         
         self.history_display.append("\n")
+        # Only a formula ending the answer can be left (its closing $ could still have grown).
+        # Its span is selected after the text above is inserted: a selection ending exactly
+        # at an insertion point would grow to include the new text.
+        self.render_streamed_formulas(self.formula_scanner.finish(), end)
+        self.history.append(self.pending_question, self.formula_scanner.text, cancelled)
+        self.trim_history()
+        self.stop_btn.setDisabled(True)
+        self.send_btn.setDisabled(False)
         self.input_field.setDisabled(False)
         self.input_field.setFocus()
 
+    def trim_history(self):
+        """Drop the oldest exchanges from the document beyond CHAT_HISTORY_TURNS; they stay in the archive."""
+        excess = len(self.exchange_starts) - CHAT_HISTORY_TURNS
+        if excess <= 0:
+            return
+        cursor = QTextCursor(self.history_display.document())
+        cursor.setPosition(self.exchange_starts[excess].position(), QTextCursor.KeepAnchor)
+        cursor.removeSelectedText()
+        for _ in range(excess):
+            self.exchange_starts.popleft()
+        self.first_exchange += excess
+
+    def on_history_scrolled(self, value):
+        if value == self.history_display.verticalScrollBar().minimum() and self.first_exchange > 0:
+            self.load_older_exchanges()
+
+    def load_older_exchanges(self):
+        """Read the previous CHAT_HISTORY_LOAD_BATCH exchanges back from the archive above the current ones."""
+        start = max(0, self.first_exchange - CHAT_HISTORY_LOAD_BATCH)
+        exchanges = self.history.load(start, self.first_exchange)
+        scrollbar = self.history_display.verticalScrollBar()
+        old_maximum = scrollbar.maximum()
+
+        cursor = QTextCursor(self.history_display.document())
+        starts = []
+        formulas = []
+        for exchange in exchanges:
+            starts.append(cursor.position())
+            cursor.insertHtml(f"<b>博士:</b> {exchange['question']}")
+            cursor.insertBlock()
+            cursor.insertHtml("<b>普瑞赛斯:</b> ")
+            for is_formula, content, raw in tokenize_formulas(exchange['answer']):
+                formula_start = cursor.position()
+                cursor.insertText(raw)
+                if is_formula:
+                    formulas.append((formula_start, cursor.position(), content))
+            if exchange['cancelled']:
+                cursor.insertHtml(" <i>（已中断）</i>")
+            cursor.insertBlock()
+            cursor.insertBlock()
+
+        # Markers and spans are created only now: a cursor sitting at an insertion point moves past the new text.
+        for position in reversed(starts):
+            marker = QTextCursor(self.history_display.document())
+            marker.setPosition(position)
+            self.exchange_starts.appendleft(marker)
+        self.first_exchange = start
+        self.render_formulas(formulas)
+        # Keep the view on the text that was at the top before loading.
+        scrollbar.setValue(scrollbar.value() + scrollbar.maximum() - old_maximum)
 
 class IngestionWorker(QThread):
     finished = pyqtSignal()
+    progress = pyqtSignal(dict)
+
+    def __init__(self, ai):
+        super().__init__()
+        self.ai = ai
     
     def run(self):
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        script_path = os.path.join(base_dir, 'ingest.py')
-        if os.path.exists(script_path):
-            try:
-                subprocess.run([sys.executable, script_path], check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Ingestion failed: {e}")
+        # Runs inside the warm process, reusing its embedding model and open vector store.
+        try:
+            self.ai.ingest(progress=self.progress.emit)
+        except Exception as e:
+            print(f"Ingestion failed: {e}")
         self.finished.emit()
 
 class DropWindow(QWidget):
     ingestion_finished = pyqtSignal()
+    ingestion_progress = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, ai):
         super().__init__()
+        self.ai = ai
         self.setWindowTitle("投喂")
         self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
         self.resize(300, 300)
@@ -164,29 +391,165 @@ class DropWindow(QWidget):
     def closeEvent(self, event):
         if self.file_list.count() > 0:
             print("Starting ingestion in background...")
-            self.worker = IngestionWorker()
+            self.worker = IngestionWorker(self.ai)
+            self.worker.progress.connect(self.on_ingestion_progress)
             self.worker.finished.connect(self.on_ingestion_finished)
             self.worker.start()
             
         event.accept()
 
+    def on_ingestion_progress(self, stats):
+        text = (f"消化中 {stats['files_done']}/{stats['files_total']} 个文件\n"
+                f"{stats['chunks']} 个知识块，{stats['chunks_per_sec']:.1f} 块/秒")
+        self.label.setText(text)
+        self.ingestion_progress.emit(text)
+
     def on_ingestion_finished(self):
         print("Ingestion finished via thread.")
         self.ingestion_finished.emit()
 
 
+class StatsWindow(QWidget):
+    """
+    p50/p95 latency per pipeline stage from the tracing layer, plus first-token latency per
+    LLM endpoint, refreshed every second while shown. For a RemotePriestess they come from
+    the server's GET /stats, fetched off the GUI thread.
+    """
+    stats_loaded = pyqtSignal(dict)
+
+    def __init__(self, ai):
+        super().__init__()
+        self.ai = ai
+        self.setWindowTitle("普瑞赛斯 - 耗时统计")
+        self.setWindowFlags(self.windowFlags() | Qt.WindowStaysOnTopHint)
+        self.resize(420, 360)
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+
+        self.hint = QLabel("未开启追踪，设置环境变量 TRACING=1 后重启即可查看。")
+        self.hint.setVisible(not tracing.TRACING)
+        self.layout.addWidget(self.hint)
+
+        self.table = QTableWidget(0, 4)
+        self.table.setHorizontalHeaderLabels(["阶段", "次数", "p50 (ms)", "p95 (ms)"])
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.layout.addWidget(self.table)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.stats_loaded.connect(self.show_stats)
+        self.fetching = False
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.timer.start(1000)
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.timer.stop()
+
+    def refresh(self):
+        if isinstance(self.ai, RemotePriestess):
+            if not self.fetching:
+                self.fetching = True
+                threading.Thread(target=self.fetch_remote, daemon=True).start()
+            return
+        llm = getattr(self.ai, "llm", None)
+        self.show_stats({
+            "tracing": tracing.TRACING,
+            "stages": tracing.stats(),
+            "llm_endpoints": llm.stats() if llm is not None else {},
+        })
+
+    def fetch_remote(self):
+        try:
+            self.stats_loaded.emit(self.ai.stats())
+        except (OSError, ValueError) as e:
+            print(f"获取服务端统计失败: {e}")
+        finally:
+            self.fetching = False
+
+    def show_stats(self, stats):
+        """Fill the table from a GET /stats shaped dict."""
+        self.hint.setVisible(not stats.get("tracing"))
+        rows = [[name, str(values["count"]), f"{values['p50_ms']:.1f}", f"{values['p95_ms']:.1f}"]
+                for name, values in stats.get("stages", {}).items()]
+        # Endpoint stats are kept whether or not tracing is on.
+        for name, values in stats.get("llm_endpoints", {}).items():
+            if values["first_token_p50_ms"] is None:
+                continue
+            label = f"首字 {name}（失败 {values['errors']}）"
+            rows.append([label, str(values["requests"]),
+                         f"{values['first_token_p50_ms']:.1f}", f"{values['first_token_p95_ms']:.1f}"])
+        self.table.setRowCount(len(rows))
+        for row, cells in enumerate(rows):
+            for column, text in enumerate(cells):
+                self.table.setItem(row, column, QTableWidgetItem(text))
+        self.table.resizeColumnsToContents()
+
 class DesktopPet(QMainWindow):
+    ai_ready = pyqtSignal(bool)
+
     def __init__(self):
         super().__init__()
-        
-        self.ai = PriestessAI()
-        
+        self.first_paint_ms = None
+
         self.initUI()
+
+        # Models and the vector store load on a background thread; chats sent before
+        # that finishes simply wait on the readiness future inside their worker thread.
+        self.ai = create_ai(background=True)
+        self.setWakingUp(True)
+        self.ai_ready.connect(self.on_ai_ready)
+        self.ai.ready.add_done_callback(lambda f: self.ai_ready.emit(f.exception() is None))
+
         self.chat_window = ChatWindow(self.ai)
-        self.drop_window = DropWindow()
-        self.drop_window.ingestion_finished.connect(self.ai.reload_knowledge)
+        self.drop_window = DropWindow(self.ai)
+        self.stats_window = StatsWindow(self.ai)
+        self.drop_window.ingestion_progress.connect(self.showIngestionProgress)
+        self.drop_window.ingestion_finished.connect(self.status_label.hide)
         
         self.drag_position = QPoint()
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_ms is None:
+            self.first_paint_ms = (time.perf_counter() - _START_TIME) * 1000
+            print(f"首次绘制耗时 {self.first_paint_ms:.0f} ms")
+
+    def setWakingUp(self, waking):
+        if waking:
+            effect = QGraphicsOpacityEffect(self.image_label)
+            effect.setOpacity(0.5)
+            self.image_label.setGraphicsEffect(effect)
+            self.image_label.setToolTip("普瑞赛斯正在苏醒...")
+            self.status_label.setText("苏醒中...")
+            self.status_label.show()
+        else:
+            self.image_label.setGraphicsEffect(None)
+            self.image_label.setToolTip("")
+            self.status_label.hide()
+
+    def startWatcher(self):
+        # Optional; a server-backed pet leaves watching to the server process.
+        if os.getenv("WATCH_DATA", "0") != "1" or isinstance(self.ai, RemotePriestess):
+            return
+        data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+        self.watcher = DataWatcher(data_dir, lambda paths: self.ai.ingest(paths=paths), self.ai.is_busy)
+        self.watcher.start()
+
+    def showIngestionProgress(self, text):
+        self.status_label.setText(text.split("\n")[0])
+        self.status_label.show()
+
+    def on_ai_ready(self, ok):
+        if ok:
+            self.setWakingUp(False)
+            self.startWatcher()
+        else:
+            self.status_label.setText("苏醒失败")
+            self.image_label.setToolTip("普瑞赛斯未能苏醒，请检查控制台输出。")
     
     def openFeed(self):
         pet_rect = self.geometry()
@@ -229,6 +592,13 @@ class DesktopPet(QMainWindow):
         self.image_label.setPixmap(pixmap)
         self.image_label.setAlignment(Qt.AlignCenter)
         self.layout.addWidget(self.image_label)
+
+        # Overlaid on the bottom of the image rather than added to the layout, so the window size is unchanged.
+        self.status_label = QLabel(self.image_label)
+        self.status_label.setAlignment(Qt.AlignCenter)
+        self.status_label.setStyleSheet("color: white; background-color: rgba(0, 0, 0, 120); border-radius: 4px;")
+        self.status_label.setGeometry(0, pixmap.height() - 24, pixmap.width(), 20)
+        self.status_label.hide()
         
         self.resize(pixmap.width(), pixmap.height())
         self.center()
@@ -295,6 +665,10 @@ class DesktopPet(QMainWindow):
         feed_action.triggered.connect(self.openFeed)
         menu.addAction(feed_action)
         
+        stats_action = QAction("耗时统计", self)
+        stats_action.triggered.connect(self.stats_window.show)
+        menu.addAction(stats_action)
+        
         clear_action = QAction("清空记忆", self)
         clear_action.triggered.connect(self.clear_data)
         menu.addAction(clear_action)
@@ -325,23 +699,16 @@ class DesktopPet(QMainWindow):
                     except Exception as e:
                         print(f"Failed to delete {file_path}. Reason: {e}")
             
-            db_path = os.path.join(base_dir, 'chroma_db')
-            if os.path.exists(db_path):
-                shutil.rmtree(db_path)
-                
-            processed_record = os.path.join(base_dir, '.processed_files')
-            if os.path.exists(processed_record):
-                os.remove(processed_record)
-            
-            print("Data and memory cleared. Starting ingestion to reset state...")
+            # With data/ empty, incremental ingestion deletes every tracked chunk from the
+            # open vector store and lexical index, so nothing has to be removed underneath them.
+            print("Data cleared. Starting ingestion to reset state...")
             
-            self.worker = IngestionWorker()
+            self.worker = IngestionWorker(self.ai)
             self.worker.finished.connect(self.on_ingestion_finished)
             self.worker.start()
             
     def on_ingestion_finished(self):
         print("Ingestion (Reset) finished.")
-        self.ai.reload_knowledge()
         QMessageBox.information(self, "完成", "普瑞赛斯的记忆已重置。")
 
     def openChat(self):
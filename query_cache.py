@@ -0,0 +1,54 @@
+import time
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Thread-safe LRU mapping bounded by entry count and, optionally, by age.
+
+    Args:
+        maxsize (int): Maximum number of entries; the least recently used is evicted first.
+        ttl (float): Seconds an entry stays valid after insertion. None or 0 disables expiry.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl or None
+        self.lock = threading.Lock()
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self.data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+def normalize_query(query):
+    """Cache key for a user question: surrounding and repeated whitespace do not matter."""
+    return " ".join(query.split())
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import threading
+import http.client
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future
+
+# When set (e.g. http://127.0.0.1:8765), the pet and the CLI talk to a running server.py
+# instead of loading their own copy of the models.
+PRIESTESS_SERVER = os.getenv("PRIESTESS_SERVER", "")
+# Seconds a chat stream may stay silent (queueing, retrieval, first token) before the client gives up.
+REMOTE_TIMEOUT = float(os.getenv("REMOTE_TIMEOUT", 120))
+
+_END = object()
+
+class RemotePriestess:
+    """Thin client for server.py exposing the parts of the PriestessAI interface the front ends use."""
+
+    def __init__(self, base_url, background=False):
+        self.base_url = base_url.rstrip("/")
+        # The server may be shared: session ids are scoped to this client so histories never mix.
+        self.client_id = uuid.uuid4().hex
+        self.ready = Future()
+        if background:
+            threading.Thread(target=self._wait_for_server, name="priestess-remote-warmup", daemon=True).start()
+        else:
+            self._wait_for_server()
+
+    def _wait_for_server(self, timeout=120):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                health = self._request("GET", "/health")
+                if health["ready"]:
+                    self.ready.set_result(None)
+                    return
+                if health.get("error"):
+                    # Warm-up failed on the server: retrying will not help.
+                    self.ready.set_exception(RuntimeError(health["error"]))
+                    return
+                error = TimeoutError(f"server not ready after {timeout}s")
+            except OSError as e:
+                error = e
+            if time.monotonic() > deadline:
+                self.ready.set_exception(error)
+                return
+            time.sleep(0.5)
+
+    def wait_until_ready(self, timeout=None):
+        self.ready.result(timeout)
+
+    def _open(self, method, path, payload=None, timeout=None):
+        data = json.dumps(payload or {}).encode("utf-8") if method == "POST" else None
+        request = urllib.request.Request(
+            self.base_url + path, data=data, method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    def _request(self, method, path, payload=None, timeout=30):
+        with self._open(method, path, payload, timeout) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def _events(self, response):
+        """Parse a Server-Sent Events stream into (event, payload) pairs."""
+        event, data = "message", []
+        for raw in response:
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:"):
+                data.append(line[5:].strip())
+            elif not line and data:
+                yield event, json.loads("\n".join(data))
+                event, data = "message", []
+
+    def _open_chat(self, query, session_id=None):
+        """POST /chat and return (connection, response) so the caller can cut the stream off at socket level."""
+        url = urllib.parse.urlsplit(self.base_url)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=REMOTE_TIMEOUT)
+        session_id = f"{self.client_id}:{session_id}" if session_id else None
+        body = json.dumps({"query": query, "session_id": session_id}).encode("utf-8")
+        try:
+            connection.request("POST", url.path + "/chat", body, {"Content-Type": "application/json"})
+            response = connection.getresponse()
+            if response.status != 200:
+                error = response.read().decode("utf-8", "replace")
+                retry_after = response.getheader("Retry-After")
+                if response.status == 503 and retry_after:
+                    raise ConnectionError(f"服务器繁忙，请 {retry_after} 秒后再试")
+                raise ConnectionError(f"HTTP {response.status}: {error}")
+        except BaseException:
+            connection.close()
+            raise
+        return connection, response
+
+    def _texts(self, response):
+        for event, payload in self._events(response):
+            if event == "message":
+                yield payload["text"]
+            elif event == "error":
+                yield f"\n[连接出错：{payload['error']}]"
+                return
+            elif event == "done":
+                return
+
+    def chat(self, query, session_id=None):
+        try:
+            self.wait_until_ready()
+        except Exception as e:
+            yield f"普瑞赛斯未能苏醒：{e}"
+            return
+        try:
+            connection, response = self._open_chat(query, session_id)
+        except OSError as e:
+            yield f"[连接出错：{e}]"
+            return
+        try:
+            yield from self._texts(response)
+        except OSError as e:
+            # Includes the socket timeout when the server stops sending mid-answer.
+            yield f"\n[连接出错：{e}]"
+        finally:
+            connection.close()
+
+    async def achat(self, query, session_id=None):
+        """Read the SSE stream on a worker thread; cancelling shuts the connection down."""
+        try:
+            await asyncio.wrap_future(self.ready)
+        except Exception as e:
+            yield f"普瑞赛斯未能苏醒：{e}"
+            return
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        try:
+            connection, response = await asyncio.to_thread(self._open_chat, query, session_id)
+        except OSError as e:
+            yield f"[连接出错：{e}]"
+            return
+        cancelled = threading.Event()
+
+        def pump():
+            try:
+                for text in self._texts(response):
+                    loop.call_soon_threadsafe(queue.put_nowait, text)
+            except Exception as e:
+                if not cancelled.is_set():
+                    loop.call_soon_threadsafe(queue.put_nowait, e)
+            loop.call_soon_threadsafe(queue.put_nowait, _END)
+
+        threading.Thread(target=pump, name="priestess-remote-chat", daemon=True).start()
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            cancelled.set()
+            # Unblocks the reading thread; the server sees the disconnect and stops generating.
+            try:
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            except (AttributeError, OSError):
+                pass
+            connection.close()
+
+    def stats(self):
+        """The server's GET /stats: tracing flag, per-stage latency and per-endpoint LLM stats."""
+        return self._request("GET", "/stats", timeout=5)
+
+    def search(self, query):
+        return self._request("POST", "/search", {"query": query})
+
+    def ingest(self, progress=None):
+        # The server does not stream ingestion progress; `progress` is accepted for interface parity.
+        return self._request("POST", "/ingest", timeout=None)
+
+    def reload_knowledge(self):
+        # The server reloads its own knowledge base after /ingest.
+        pass
+
+def create_ai(background=False):
+    """A RemotePriestess when PRIESTESS_SERVER is set, otherwise a local PriestessAI."""
+    if PRIESTESS_SERVER:
+        return RemotePriestess(PRIESTESS_SERVER, background=background)
+    from main import PriestessAI
+    return PriestessAI(background=background)
@@ -0,0 +1,29 @@
+RERANK_MODEL = "BAAI/bge-reranker-base"
+
+class CrossEncoderReranker:
+    """
+    Scores (question, chunk) pairs with a local cross-encoder and keeps the best k.
+
+    Args:
+        model_name (str): Hugging Face cross-encoder model.
+        batch_size (int): Pairs scored per forward pass.
+        device (str): Torch device; the default CPU matches the embedding engine's deployment.
+    """
+
+    def __init__(self, model_name=RERANK_MODEL, batch_size=16, device="cpu"):
+        from sentence_transformers import CrossEncoder
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, device=device, max_length=512)
+
+    def rerank(self, query, docs, k):
+        if len(docs) <= 1:
+            return list(docs)
+        scores = self.model.predict(
+            [(query, doc.page_content) for doc in docs],
+            batch_size=self.batch_size,
+            show_progress_bar=False,
+        )
+        order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [docs[i] for i in order[:k]]
@@ -0,0 +1,221 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from main import PriestessAI
+from watcher import DataWatcher
+import tracing
+
+SERVER_HOST = os.getenv("PRIESTESS_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("PRIESTESS_PORT", 8765))
+# Answers generated at once; further requests wait in a queue of at most MAX_QUEUED_CHATS,
+# beyond which they are rejected with 503 so clients back off instead of piling up.
+MAX_CONCURRENT_CHATS = int(os.getenv("MAX_CONCURRENT_CHATS", 4))
+MAX_QUEUED_CHATS = int(os.getenv("MAX_QUEUED_CHATS", 16))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 30))
+MAX_CONCURRENT_SEARCHES = int(os.getenv("MAX_CONCURRENT_SEARCHES", 8))
+
+class Admission:
+    """Concurrency limit with a bounded wait queue."""
+
+    def __init__(self, limit, max_waiting):
+        self.slots = threading.Semaphore(limit)
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def admit(self, timeout):
+        """Yield True once a slot is held, or False if the queue is full or the wait timed out."""
+        acquired = self.slots.acquire(blocking=False)
+        if not acquired:
+            with self.lock:
+                if self.waiting >= self.max_waiting:
+                    yield False
+                    return
+                self.waiting += 1
+            try:
+                acquired = self.slots.acquire(timeout=timeout)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+        if not acquired:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.slots.release()
+
+class PriestessServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, ai):
+        super().__init__(address, PriestessHandler)
+        self.ai = ai
+        self.chat_admission = Admission(MAX_CONCURRENT_CHATS, MAX_QUEUED_CHATS)
+        self.search_admission = Admission(MAX_CONCURRENT_SEARCHES, MAX_QUEUED_CHATS)
+        self.ingest_lock = threading.Lock()
+
+class PriestessHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        body = json.loads(self.rfile.read(length).decode("utf-8"))
+        if not isinstance(body, dict):
+            raise ValueError("request body must be a JSON object")
+        return body
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_busy(self):
+        self.send_json(503, {"error": "busy"}, {"Retry-After": "2"})
+
+    def do_GET(self):
+        if self.path == "/health":
+            warmup = self.server.ai.ready
+            if warmup is None:
+                self.send_json(200, {"ready": True})
+            elif not warmup.done():
+                self.send_json(200, {"ready": False})
+            elif warmup.exception() is not None:
+                self.send_json(200, {"ready": False, "error": str(warmup.exception())})
+            else:
+                self.send_json(200, {"ready": True})
+        elif self.path == "/stats":
+            llm = self.server.ai.llm
+            self.send_json(200, {
+                "tracing": tracing.TRACING,
+                "stages": tracing.stats(),
+                "llm_endpoints": llm.stats() if llm is not None else {},
+            })
+        else:
+            self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError as e:
+            self.send_json(400, {"error": f"invalid JSON: {e}"})
+            return
+        routes = {"/chat": self.handle_chat, "/search": self.handle_search, "/ingest": self.handle_ingest}
+        handler = routes.get(self.path)
+        if handler is None:
+            self.send_json(404, {"error": "not found"})
+        else:
+            handler(body)
+
+    def handle_chat(self, body):
+        query = (body.get("query") or "").strip()
+        if not query:
+            self.send_json(400, {"error": "query is required"})
+            return
+
+        with self.server.chat_admission.admit(QUEUE_TIMEOUT) as admitted:
+            if not admitted:
+                self.send_busy()
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            stream = self.server.ai.chat(query, session_id=body.get("session_id"))
+            try:
+                for chunk in stream:
+                    self.send_event("message", {"text": chunk})
+                self.send_event("done", {})
+            except (BrokenPipeError, ConnectionResetError):
+                # Client went away: closing the generator also closes the upstream LLM stream.
+                pass
+            except Exception as e:
+                try:
+                    self.send_event("error", {"error": str(e)})
+                except OSError:
+                    pass
+            finally:
+                stream.close()
+
+    def send_event(self, event, payload):
+        data = json.dumps(payload, ensure_ascii=False)
+        self.wfile.write(f"event: {event}\ndata: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def handle_search(self, body):
+        query = (body.get("query") or "").strip()
+        if not query:
+            self.send_json(400, {"error": "query is required"})
+            return
+
+        with self.server.search_admission.admit(QUEUE_TIMEOUT) as admitted:
+            if not admitted:
+                self.send_busy()
+                return
+            ai = self.server.ai
+            try:
+                ai.wait_until_ready()
+            except Exception as e:
+                self.send_json(503, {"error": f"warm-up failed: {e}"})
+                return
+            if ai.vectorstore is None:
+                self.send_json(503, {"error": "knowledge base not loaded"})
+                return
+            try:
+                docs, timings = ai.retrieve_timed(query)
+                results = [{
+                    "id": doc.id,
+                    "source": doc.metadata.get("source"),
+                    "page": doc.metadata.get("page", 0) + 1,
+                    "content": doc.page_content,
+                } for doc in docs]
+            except Exception as e:
+                self.send_json(500, {"error": str(e)})
+                return
+            self.send_json(200, {"results": results, "timings": timings})
+
+    def handle_ingest(self, body):
+        if not self.server.ingest_lock.acquire(blocking=False):
+            self.send_json(409, {"error": "ingestion already running"})
+            return
+        try:
+            self.server.ai.ingest()
+            self.send_json(200, {"ok": True})
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+        finally:
+            self.server.ingest_lock.release()
+
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+    ai = PriestessAI(background=True)
+    server = PriestessServer((host, port), ai)
+    if os.getenv("WATCH_DATA", "0") == "1":
+        from ingest import DATA_PATH
+        DataWatcher(DATA_PATH, lambda paths: ai.ingest(paths=paths), ai.is_busy).start()
+    print(f"普瑞赛斯在 http://{host}:{port} 等候博士的连接...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    serve()
@@ -1,13 +1,170 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import io
-import base64
+import os
 import re
+import time
+import base64
+import sqlite3
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from query_cache import LRUCache
+from tracing import record
+
+load_dotenv()
+
+# Rendered formulas kept in memory, and on disk across restarts (0 disables either).
+FORMULA_CACHE_SIZE = int(os.getenv("FORMULA_CACHE_SIZE", 512))
+FORMULA_DISK_CACHE_PATH = os.getenv("FORMULA_DISK_CACHE_PATH", "./formula_cache.sqlite")
+FORMULA_DISK_CACHE_ENTRIES = int(os.getenv("FORMULA_DISK_CACHE_ENTRIES", 5000))
+# Same margin bbox_inches='tight' used to add around the formula.
+PAD_INCHES = 0.02
+
+def normalize_formula(latex_code):
+    """The math-mode string actually rendered: whitespace/newlines collapsed and wrapped in $ if needed."""
+    cleaned_code = latex_code.strip().replace('\n', ' ')
+    if not cleaned_code.startswith('$'):
+        return f"${cleaned_code}$"
+    return cleaned_code
+
+def cache_key(latex_code, fontsize=12, dpi=120, color='black'):
+    return (normalize_formula(latex_code), fontsize, dpi, color)
+
+def formula_key(latex_code, fontsize=12, dpi=120, color='black'):
+    """Stable short id of a rendered formula, e.g. for referencing it as a document resource."""
+    return hashlib.sha256(repr(cache_key(latex_code, fontsize, dpi, color)).encode('utf-8')).hexdigest()[:32]
+
+class FormulaDiskCache:
+    """PNG bytes keyed by sha256 of the render parameters, bounded by entry count (least recently used go first)."""
+
+    def __init__(self, path=FORMULA_DISK_CACHE_PATH, max_entries=FORMULA_DISK_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS formulas ("
+            " key BLOB PRIMARY KEY, png BLOB NOT NULL, last_used REAL NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT png FROM formulas WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE formulas SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, key, png):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO formulas (key, png, last_used) VALUES (?, ?, ?)",
+                (key, png, time.time()),
+            )
+            self.conn.execute(
+                "DELETE FROM formulas WHERE key IN ("
+                " SELECT key FROM formulas ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self.conn.commit()
+
+_memory_cache = LRUCache(maxsize=FORMULA_CACHE_SIZE)
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+_parser = None
+
+def _get_disk_cache():
+    global _disk_cache
+    if FORMULA_DISK_CACHE_ENTRIES <= 0:
+        return None
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            try:
+                _disk_cache = FormulaDiskCache()
+            except sqlite3.Error as e:
+                print(f"无法打开公式缓存，将只使用内存缓存: {e}")
+                _disk_cache = False
+    return _disk_cache or None
+
+def render_with_mathtext(render_text, fontsize=12, dpi=120, color='black'):
+    """
+    Render a math-mode string to PNG bytes with matplotlib's mathtext parser.
+
+    The parser measures the formula once, so the figure is created at its final size
+    and saved without bbox_inches='tight' (which draws the figure twice); no pyplot
+    figure manager or global state is involved.
+    """
+    global _parser
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.mathtext import MathTextParser
+
+    if _parser is None:
+        _parser = MathTextParser("path")
+    prop = FontProperties(size=fontsize)
+    width, height, depth, _, _ = _parser.parse(render_text, dpi=72, prop=prop)
+
+    fig_width = width / 72 + 2 * PAD_INCHES
+    fig_height = height / 72 + 2 * PAD_INCHES
+    fig = Figure(figsize=(fig_width, fig_height))
+    FigureCanvasAgg(fig)
+    fig.text(PAD_INCHES / fig_width, (PAD_INCHES + depth / 72) / fig_height, render_text,
+             fontproperties=prop, color=color)
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi, transparent=True)
+    return buf.getvalue()
 
 def render_latex_to_base64(latex_code, fontsize=12, dpi=120, color='black'):
     """
     Render a LaTeX string to a base64 encoded PNG image.
+
+    Results are cached in memory and on disk, keyed by (formula, fontsize, dpi, color).
+    Misses go through the mathtext fast path, falling back to the pyplot renderer.
+
+    Args:
+        latex_code (str): The LaTeX formula string (e.g., r"$E=mc^2$"); wrapped in $ if missing.
+        fontsize (int): Font size of the formula.
+        dpi (int): Dots per inch for the output image.
+        color (str): Text color.
+
+    Returns:
+        str: Base64 encoded string of the PNG image, or None if failed.
+    """
+    key = cache_key(latex_code, fontsize, dpi, color)
+    render_text = key[0]
+    cached = _memory_cache.get(key)
+    if cached is not None:
+        return cached
+
+    disk_cache = _get_disk_cache()
+    disk_key = hashlib.sha256(repr(key).encode('utf-8')).digest()
+    png = disk_cache.get(disk_key) if disk_cache else None
+    if png is None:
+        try:
+            png = render_with_mathtext(render_text, fontsize, dpi, color)
+        except Exception:
+            b64 = render_with_pyplot(render_text, fontsize, dpi, color)
+            if b64 is None:
+                return None
+            png = base64.b64decode(b64)
+        if disk_cache:
+            disk_cache.put(disk_key, png)
+
+    b64 = base64.b64encode(png).decode('utf-8')
+    _memory_cache.put(key, b64)
+    return b64
+
+def render_with_pyplot(latex_code, fontsize=12, dpi=120, color='black'):
+    """
+    Render a LaTeX string to a base64 encoded PNG image through a full pyplot figure.
+
+    The original renderer, kept as the fallback for formulas the mathtext fast path
+    rejects and as the baseline for benchmark().
     
     Args:
         latex_code (str): The LaTeX formula string (e.g., r"$E=mc^2$").
@@ -19,6 +176,10 @@ def render_latex_to_base64(latex_code, fontsize=12, dpi=120, color='black'):
     Returns:
         str: Base64 encoded string of the PNG image, or None if failed.
     """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     try:
         # Create a figure
         fig = plt.figure(figsize=(0.1, 0.1))
@@ -71,72 +232,222 @@ def render_latex_to_base64(latex_code, fontsize=12, dpi=120, color='black'):
         plt.close(fig) if 'fig' in locals() else None
         return None
 
+# One alternation instead of one regex pass per delimiter; earlier alternatives win at the
+# same position, so $$...$$ is never read as two inline formulas. Single $ is risky with
+# currency, but the model reliably emits markdown LaTeX.
+_FORMULA_PATTERN = re.compile(
+    r'\$\$(?P<block>.*?)\$\$'
+    r'|\\\[(?P<bracket>.*?)\\\]'
+    r'|(?<!\$)\$(?!\$)(?P<inline>.*?)(?<!\$)\$(?!\$)'
+    r'|\\\((?P<paren>.*?)\\\)',
+    re.DOTALL,
+)
+
+def tokenize_formulas(text):
+    """
+    Split text into segments in a single scan.
+
+    Supported delimiters: $$ ... $$ and \\[ ... \\] (block), $ ... $ and \\( ... \\) (inline).
+
+    Returns:
+        list: (is_formula, content, raw) tuples; for plain text content == raw.
+    """
+    segments = []
+    position = 0
+    for match in _FORMULA_PATTERN.finditer(text):
+        if match.start() > position:
+            segments.append((False, text[position:match.start()], text[position:match.start()]))
+        content = next(group for group in match.groups() if group is not None)
+        segments.append((True, content, match.group(0)))
+        position = match.end()
+    if position < len(text):
+        segments.append((False, text[position:], text[position:]))
+    return segments
+
+# Longest stretch an unclosed opening delimiter may hold back formula detection before
+# it is taken to be a literal character (a stray $ in prose, say).
+FORMULA_MAX_CHARS = 2000
+_OPENER_PATTERN = re.compile(r'\$|\\\[|\\\(')
+
+class StreamingFormulaScanner:
+    """
+    Finds formulas in streamed text as soon as their closing delimiter has arrived.
+
+    feed() returns (start, end, content) for each newly completed formula, with offsets
+    into the whole text fed so far; finish() settles what is left once the stream ends.
+    Results match tokenize_formulas() on the full text except around openers left
+    unclosed for more than FORMULA_MAX_CHARS characters.
+
+    Settled text is kept as a list of parts, so only the unsettled tail is rescanned
+    and nothing is copied per chunk beyond that tail.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.settled = 0
+        # Text after the settled prefix that may still turn out to be part of a formula.
+        self.pending = ""
+        self.length = 0
+
+    @property
+    def text(self):
+        return "".join(self.parts) + self.pending
+
+    def feed(self, chunk):
+        self.pending += chunk
+        self.length += len(chunk)
+        return self._scan(final=False)
+
+    def finish(self):
+        return self._scan(final=True)
+
+    def _scan(self, final):
+        # The last settled character is kept in front so the (?<!\$) lookbehinds still see it.
+        context = self.parts[-1][-1:] if self.parts else ""
+        text = context + self.pending
+        base = self.settled - len(context)
+        found = []
+        position = len(context)
+        while True:
+            match = _FORMULA_PATTERN.search(text, position)
+            opener = _OPENER_PATTERN.search(text, position)
+            if not final and opener is not None and (match is None or opener.start() < match.start()):
+                # An earlier delimiter may still close and swallow any later match.
+                if len(text) - opener.start() <= FORMULA_MAX_CHARS:
+                    keep = opener.start()
+                    break
+                position = opener.end()
+                continue
+            if final:
+                keep = len(text)
+                if match is None:
+                    break
+            elif match is not None and match.end() >= len(text):
+                # A closing delimiter at the very end may still grow ($ into $$).
+                keep = match.start()
+                break
+            elif match is None:
+                # A trailing backslash may become \[ or \( with the next chunk.
+                keep = len(text) - 1 if text.endswith('\\') else len(text)
+                break
+            content = next(group for group in match.groups() if group is not None)
+            found.append((base + match.start(), base + match.end(), content))
+            position = match.end()
+
+        if keep > len(context):
+            self.parts.append(text[len(context):keep])
+            self.settled = base + keep
+        self.pending = text[keep:]
+        return found
+
+def formula_img_tag(src):
+    # vertical-align: middle helps inline formulas align better
+    return f'<img src="{src}" style="vertical-align: middle;">'
+
+def _assemble(segments, images):
+    parts = []
+    for is_formula, content, raw in segments:
+        if not is_formula:
+            parts.append(raw)
+        elif images.get(content):
+            parts.append(formula_img_tag(f"data:image/png;base64,{images[content]}"))
+        else:
+            parts.append(raw)
+    return "".join(parts)
+
 def process_text_with_formulas(text):
+    """Replace LaTeX formulas in text with base64 images, rendering synchronously in this process."""
+    segments = tokenize_formulas(text)
+    images = {}
+    for is_formula, content, _ in segments:
+        if is_formula and content not in images:
+            images[content] = render_latex_to_base64(content)
+    return _assemble(segments, images)
+
+# matplotlib is not thread-safe, so concurrent rendering uses processes.
+FORMULA_WORKERS = int(os.getenv("FORMULA_WORKERS", min(4, os.cpu_count() or 1)))
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the GUI process holds Qt threads that must not be forked.
+            ctx = multiprocessing.get_context("spawn")
+            _pool = ProcessPoolExecutor(max_workers=FORMULA_WORKERS, mp_context=ctx)
+        return _pool
+
+def render_formula_async(latex_code, on_done):
     """
-    Scan text for LaTeX patterns and replace them with base64 images.
-    
-    Supported patterns:
-    - $$ ... $$ (Block math)
-    - \[ ... \] (Block math)
-    - $ ... $ (Inline math) - Note: simple $ matching can be risky with currency.
-      We'll try to be careful or strictly support standard delimiters.
-      
-    For this MVP, we will prioritize standard markdown latex delimiters.
+    Return the cached base64 image for one formula, or None after starting its render
+    in the process pool; on_done is then called with the base64 string (None if rendering
+    failed) from a pool thread.
     """
-    
-    # Placeholder for replacements to avoid recursive mess
-    replacements = {}
-    
-    def replacer(match):
-        full_match = match.group(0)
-        content = match.group(1)
-        
-        # Generate a unique key
-        key = f"__LATEX_{len(replacements)}__"
-        
-        # Render
-        b64 = render_latex_to_base64(content)
+    key = cache_key(latex_code)
+    cached = _memory_cache.get(key)
+    if cached is not None:
+        return cached
+    submitted = time.perf_counter()
+
+    def finished(future):
+        try:
+            b64 = future.result()
+        except Exception as e:
+            print(f"Error rendering LaTeX: {e}")
+            b64 = None
         if b64:
-            # Create HTML img tag
-            # vertical-align: middle helps inline formulas align better
-            img_tag = f'<img src="data:image/png;base64,{b64}" style="vertical-align: middle;">'
-            replacements[key] = img_tag
-            return key
-        else:
-            return full_match
+            _memory_cache.put(key, b64)
+        # Queueing in the pool included: this is how long the placeholder stays on screen.
+        record("formula.render", time.perf_counter() - submitted)
+        on_done(b64)
 
-    # Regex for $$ ... $$
-    # Non-greedy match, handling newlines
-    pattern_block_dollar = re.compile(r'\$\$(.*?)\$\$', re.DOTALL)
-    text = pattern_block_dollar.sub(replacer, text)
-    
-    # Regex for \[ ... \]
-    pattern_block_bracket = re.compile(r'\\\[(.*?)\\\]', re.DOTALL)
-    text = pattern_block_bracket.sub(replacer, text)
-    
-    # Regex for $ ... $
-    # We need to be careful not to match simple prices e.g. "Price is $5 and $10"
-    # A common heuristic is looking for no space after opening $ and no space before closing $
-    # or ensuring the content is math-like.
-    # For now, let's use a simpler known pattern provided by LLMs often: $...$
-    pattern_inline = re.compile(r'(?<!\$)\$(?!\$)(.*?)(?<!\$)\$(?!\$)', re.DOTALL)
-    # text = pattern_inline.sub(replacer, text) 
-    # COMMENT: Enabling inline math with single $ risk false positives. 
-    # Let's enable it but be cautious or let the user know. 
-    # Since this is a specialized AI, it likely outputs correct markdown latex.
-    text = pattern_inline.sub(replacer, text)
-
-    # Regex for \( ... \)
-    pattern_inline_bracket = re.compile(r'\\\((.*?)\\\)', re.DOTALL)
-    text = pattern_inline_bracket.sub(replacer, text)
-
-    # Post-process: substitute keys back with images
-    for key, img_tag in replacements.items():
-        text = text.replace(key, img_tag)
-        
-    return text
+    _get_pool().submit(render_latex_to_base64, latex_code).add_done_callback(finished)
+    return None
+
+BENCHMARK_FORMULAS = [r"E=mc^2", r"\frac{a}{b}", r"\sum_{i=1}^{n} x_i^2", r"\int_0^1 f(x)\,dx",
+                      r"\alpha + \beta = \gamma", r"\sqrt{x^2 + y^2}", r"\nabla \cdot \vec{E}",
+                      r"P(A|B) = \frac{P(B|A)P(A)}{P(B)}"]
+
+def benchmark(formulas, rounds=3):
+    """
+    Renders/sec of the original pyplot path, the mathtext fast path, and the cached
+    render_latex_to_base64 over `rounds` passes of `formulas` (repeats hit the cache).
+    """
+    global _disk_cache
+    # Warm up so matplotlib's import and font loading are not billed to the first path.
+    render_with_pyplot(formulas[0])
+    render_with_mathtext(normalize_formula(formulas[0]))
+
+    results = {}
+    start = time.perf_counter()
+    for formula in formulas:
+        render_with_pyplot(formula)
+    results["pyplot"] = len(formulas) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for formula in formulas:
+        render_with_mathtext(normalize_formula(formula))
+    results["mathtext"] = len(formulas) / (time.perf_counter() - start)
+
+    _memory_cache.clear()
+    _disk_cache = False
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for formula in formulas:
+            render_latex_to_base64(formula)
+    results["cached"] = rounds * len(formulas) / (time.perf_counter() - start)
+    _disk_cache = None
+    return results
 
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:] == ["--benchmark"]:
+        for name, rate in benchmark(BENCHMARK_FORMULAS * 4).items():
+            print(f"{name}: {rate:.1f} renders/sec")
+        sys.exit()
+
     # Simple test
     test_str = "Here is a formula: $E=mc^2$ and another one $$ a^2 + b^2 = c^2 $$."
     print("Original:", test_str)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import uuid
+import logging
+import functools
+import threading
+import contextvars
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Off by default; when off, span() hands back one shared no-op object and nothing is timed.
+TRACING = os.getenv("TRACING", "0") == "1"
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "./traces.jsonl")
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_BYTES", 5 * 1024 * 1024))
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", 3))
+# Durations kept per span name for the percentile stats.
+TRACE_STATS_WINDOW = int(os.getenv("TRACE_STATS_WINDOW", 1000))
+
+_current = contextvars.ContextVar("priestess_span", default=None)
+_logger = None
+_logger_lock = threading.Lock()
+_durations = {}
+_durations_lock = threading.Lock()
+
+def _get_logger():
+    global _logger
+    with _logger_lock:
+        if _logger is None:
+            logger = logging.getLogger("priestess.trace")
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            handler = RotatingFileHandler(TRACE_LOG_PATH, maxBytes=TRACE_LOG_MAX_BYTES,
+                                          backupCount=TRACE_LOG_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            _logger = logger
+    return _logger
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+class Span:
+    """One timed stage; nested spans in the same context share the trace id and point to their parent."""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.id = uuid.uuid4().hex[:16]
+        self.parent = None
+        self.trace_id = None
+        self.token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self.trace_id = self.parent.trace_id if self.parent else uuid.uuid4().hex[:16]
+        self.token = _current.set(self)
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        try:
+            _current.reset(self.token)
+        except ValueError:
+            # A generator closed from another context; its context is gone anyway.
+            pass
+        _emit(self.name, duration, self.attrs, self.trace_id, self.id,
+              self.parent.id if self.parent else None, self.wall_start, exc)
+        return False
+
+def span(name, **attrs):
+    """Context manager timing one pipeline stage; a shared no-op when TRACING is off."""
+    if not TRACING:
+        return _NOOP_SPAN
+    return Span(name, attrs)
+
+def traced(name):
+    """Decorator running the whole function inside span(name)."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def isolated(generator):
+    """
+    Run each step of `generator` in its own copy of the consumer's context, so spans it
+    keeps open across yields never leak into the code iterating it (or into another
+    generator interleaved on the same thread).
+    """
+    if not TRACING:
+        yield from generator
+        return
+    context = contextvars.copy_context()
+    try:
+        while True:
+            try:
+                item = context.run(next, generator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        context.run(generator.close)
+
+def record(name, seconds, **attrs):
+    """Log a duration measured elsewhere (e.g. time to first token) as a span of the current trace."""
+    if not TRACING:
+        return
+    parent = _current.get()
+    _emit(name, seconds, attrs, parent.trace_id if parent else uuid.uuid4().hex[:16],
+          uuid.uuid4().hex[:16], parent.id if parent else None, time.time() - seconds, None)
+
+def _emit(name, duration, attrs, trace_id, span_id, parent_id, wall_start, exc):
+    with _durations_lock:
+        window = _durations.get(name)
+        if window is None:
+            window = _durations[name] = deque(maxlen=TRACE_STATS_WINDOW)
+        window.append(duration)
+    entry = {
+        "trace": trace_id,
+        "span": span_id,
+        "parent": parent_id,
+        "name": name,
+        "start": round(wall_start, 6),
+        "ms": round(duration * 1000, 3),
+    }
+    if attrs:
+        entry["attrs"] = attrs
+    if exc is not None:
+        entry["error"] = repr(exc)
+    try:
+        _get_logger().info(json.dumps(entry, ensure_ascii=False, default=str))
+    except OSError:
+        pass
+
+def stats():
+    """{span name: {"count", "p50_ms", "p95_ms"}} over the last TRACE_STATS_WINDOW spans of each name."""
+    with _durations_lock:
+        snapshot = {name: sorted(window) for name, window in _durations.items()}
+    result = {}
+    for name, values in sorted(snapshot.items()):
+        if not values:
+            continue
+        pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+        result[name] = {"count": len(values), "p50_ms": pick(0.5), "p95_ms": pick(0.95)}
+    return result
@@ -0,0 +1,339 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:
+    # No flock on Windows; writers are then only serialized within one process.
+    fcntl = None
+
+load_dotenv()
+
+# "chroma" (default) or "mmap", the memory-mapped NumPy index below.
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+CHROMA_PATH = "./chroma_db"
+MMAP_INDEX_PATH = os.getenv("MMAP_INDEX_PATH", "./vector_index")
+# float16 halves memory against float32 with no measurable recall loss on normalized vectors;
+# int8 halves it again at a small precision cost.
+MMAP_DTYPE = os.getenv("MMAP_DTYPE", "float16")
+# Rows scored per matrix product; bounds the float32 temporaries during a search.
+SEARCH_BLOCK_ROWS = 65536
+# ingest.py compacts the index once this share of its rows is tombstoned.
+MMAP_COMPACT_RATIO = float(os.getenv("MMAP_COMPACT_RATIO", 0.3))
+
+_INT8_SCALE = 127.0
+
+class MmapVectorStore:
+    """
+    Append-only vector index in memory-mapped files, answering the subset of the Chroma
+    interface PriestessAI and ingest.py use.
+
+    Layout of the index directory:
+        meta.json     dimension and dtype
+        vectors.bin   one normalized vector per row (float16 or int8)
+        chunks.jsonl  {"id", "text", "metadata"} per row
+        offsets.bin   uint64 byte offset of each row in chunks.jsonl
+        ids.txt       chunk id per row
+        deleted.bin   uint8 tombstone per row
+
+    Opening maps the files instead of reading them, so it is near-instant and processes
+    opening the same index share its pages through the OS page cache. Search is one
+    matrix product per block of rows; deleted rows are masked until compact() rewrites
+    the files without them. Writers in different processes are serialized with flock.
+    """
+
+    def __init__(self, path=MMAP_INDEX_PATH, embedding_function=None, dtype=MMAP_DTYPE):
+        import numpy as np
+
+        self.np = np
+        self.path = path
+        self.embeddings = embedding_function
+        self.lock = threading.RLock()
+        self.write_depth = 0
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            self.dim, self.dtype = meta["dim"], meta["dtype"]
+        else:
+            self.dim, self.dtype = None, dtype
+        self.rows = 0
+        self.vectors = None
+        self.offsets = None
+        self.deleted = None
+        self.ids = []
+        self.row_of = None
+        self.chunks_file = None
+        self.vectors_key = None
+        self.refresh()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def row_bytes(self):
+        return self.dim * self.np.dtype(self.dtype).itemsize
+
+    def refresh(self):
+        """Remap the files if another process (or this one) appended rows since the last call."""
+        with self.lock:
+            if self.dim is None:
+                return
+            try:
+                st = os.stat(self._file("vectors.bin"))
+                key = (st.st_ino, st.st_size)
+            except FileNotFoundError:
+                key = (None, 0)
+            if key == self.vectors_key:
+                return
+            np = self.np
+            # vectors.bin is written last in an append (and replaced last by compact()), so its
+            # row count is authoritative; side files may hold rows a writer has not finished.
+            rows = key[1] // self.row_bytes
+            self.vectors = self.offsets = self.deleted = None
+            self.ids = []
+            if rows:
+                self.vectors = np.memmap(self._file("vectors.bin"), dtype=self.dtype, mode="r", shape=(rows, self.dim))
+                self.offsets = np.memmap(self._file("offsets.bin"), dtype=np.uint64, mode="r", shape=(rows,))
+                self.deleted = np.memmap(self._file("deleted.bin"), dtype=np.uint8, mode="r", shape=(rows,))
+                with open(self._file("ids.txt"), "r", encoding="utf-8") as f:
+                    self.ids = f.read().split("\n")[:rows]
+                # Not closed: a search still holding the previous snapshot may read from it.
+                self.chunks_file = open(self._file("chunks.jsonl"), "rb")
+            self.row_of = None
+            self.rows = rows
+            self.vectors_key = key
+
+    @contextmanager
+    def _writing(self):
+        """Exclusive write access: the thread lock plus, where available, flock on the index directory."""
+        with self.lock:
+            # Re-entrant like the RLock (add_vectors calls delete): flock on a second descriptor
+            # of the same file would wait for this thread's own lock.
+            if fcntl is None or self.write_depth:
+                self.write_depth += 1
+                try:
+                    yield
+                finally:
+                    self.write_depth -= 1
+                return
+            with open(self._file(".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self.write_depth = 1
+                try:
+                    yield
+                finally:
+                    self.write_depth = 0
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _repair(self):
+        """Cut every file back to the committed row count, dropping the remains of an interrupted append."""
+        rows = self.rows
+        for name, itemsize in (("vectors.bin", self.row_bytes), ("offsets.bin", 8), ("deleted.bin", 1)):
+            path = self._file(name)
+            if os.path.exists(path) and os.path.getsize(path) > rows * itemsize:
+                os.truncate(path, rows * itemsize)
+        if os.path.exists(self._file("ids.txt")):
+            with open(self._file("ids.txt"), "r", encoding="utf-8") as f:
+                ids = f.read().split("\n")
+            # A well-formed file ends with a newline, leaving one empty trailing element;
+            # anything after the last committed id is an extra or half-written line.
+            if len(ids) > rows + 1 or (len(ids) == rows + 1 and ids[-1]):
+                with open(self._file("ids.txt"), "w", encoding="utf-8") as f:
+                    f.write("".join(i + "\n" for i in ids[:rows]))
+        # Orphaned chunk records are harmless: rows point at their own offsets.
+
+    def _row_index(self):
+        if self.row_of is None:
+            self.row_of = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        return self.row_of
+
+    def _normalize(self, vectors):
+        np = self.np
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _encode(self, vectors):
+        if self.dtype == "int8":
+            return self.np.clip(self.np.rint(vectors * _INT8_SCALE), -127, 127).astype(self.np.int8)
+        return vectors.astype(self.dtype)
+
+    def add_documents(self, documents, ids):
+        vectors = self._normalize(self.embeddings.embed_documents([doc.page_content for doc in documents]))
+        self.add_vectors(vectors, [doc.page_content for doc in documents],
+                         [doc.metadata for doc in documents], ids)
+        return list(ids)
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        np = self.np
+        with self._writing():
+            if self.dim is None and os.path.exists(self._file("meta.json")):
+                # Another process created the index since this one was opened.
+                with open(self._file("meta.json"), "r") as f:
+                    meta = json.load(f)
+                self.dim, self.dtype = meta["dim"], meta["dtype"]
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self._file("meta.json"), "w") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+            self.refresh()
+            self._repair()
+            # Ids written again replace their previous row (like Chroma's upsert).
+            known = self._row_index() if self.rows else {}
+            replaced = [chunk_id for chunk_id in ids if chunk_id in known]
+            if replaced:
+                self.delete(replaced)
+
+            with open(self._file("chunks.jsonl"), "ab") as f:
+                offsets = []
+                for chunk_id, text, metadata in zip(ids, texts, metadatas):
+                    offsets.append(f.tell())
+                    f.write(json.dumps({"id": chunk_id, "text": text, "metadata": metadata or {}},
+                                       ensure_ascii=False).encode("utf-8") + b"\n")
+            with open(self._file("offsets.bin"), "ab") as f:
+                f.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+            with open(self._file("ids.txt"), "a", encoding="utf-8") as f:
+                f.write("".join(chunk_id + "\n" for chunk_id in ids))
+            with open(self._file("deleted.bin"), "ab") as f:
+                f.write(bytes(len(ids)))
+            with open(self._file("vectors.bin"), "ab") as f:
+                f.write(self._encode(vectors).tobytes())
+            self.refresh()
+
+    def delete(self, ids):
+        np = self.np
+        with self._writing():
+            self.refresh()
+            row_of = self._row_index()
+            rows = sorted(row_of[chunk_id] for chunk_id in ids if chunk_id in row_of)
+            if not rows:
+                return
+            tombstones = np.memmap(self._file("deleted.bin"), dtype=np.uint8, mode="r+", shape=(self.rows,))
+            tombstones[rows] = 1
+            tombstones.flush()
+            for chunk_id in ids:
+                row_of.pop(chunk_id, None)
+
+    def dead_ratio(self):
+        """Share of rows that are tombstoned and still take space and search time."""
+        self.refresh()
+        return float(self.deleted.mean()) if self.rows else 0.0
+
+    def compact(self):
+        """
+        Rewrite the index without tombstoned rows. Each file is built next to the index and
+        swapped in with os.replace, vectors.bin last, so readers in other processes keep
+        their old mapping until they next refresh and then see a consistent new one.
+        """
+        np = self.np
+        with self._writing():
+            self.refresh()
+            self._repair()
+            if not self.rows:
+                return
+            live = np.flatnonzero(np.asarray(self.deleted) == 0)
+            tmp = self._file("compact.tmp")
+            os.makedirs(tmp, exist_ok=True)
+            offsets = []
+            with open(os.path.join(tmp, "chunks.jsonl"), "wb") as out:
+                for row in live:
+                    self.chunks_file.seek(int(self.offsets[row]))
+                    offsets.append(out.tell())
+                    out.write(self.chunks_file.readline())
+            with open(os.path.join(tmp, "offsets.bin"), "wb") as f:
+                f.write(np.asarray(offsets, dtype=np.uint64).tobytes())
+            with open(os.path.join(tmp, "ids.txt"), "w", encoding="utf-8") as f:
+                f.write("".join(self.ids[row] + "\n" for row in live))
+            with open(os.path.join(tmp, "deleted.bin"), "wb") as f:
+                f.write(bytes(len(live)))
+            with open(os.path.join(tmp, "vectors.bin"), "wb") as f:
+                for start in range(0, len(live), SEARCH_BLOCK_ROWS):
+                    f.write(np.ascontiguousarray(self.vectors[live[start:start + SEARCH_BLOCK_ROWS]]).tobytes())
+            for name in ("chunks.jsonl", "offsets.bin", "ids.txt", "deleted.bin", "vectors.bin"):
+                os.replace(os.path.join(tmp, name), self._file(name))
+            os.rmdir(tmp)
+            print(f"向量索引已压缩：{self.rows} 行 -> {len(live)} 行")
+            self.refresh()
+
+    def _documents(self, rows, offsets=None, chunks_file=None):
+        from langchain_core.documents import Document
+
+        docs = []
+        with self.lock:
+            offsets = self.offsets if offsets is None else offsets
+            chunks_file = chunks_file or self.chunks_file
+            for row in rows:
+                chunks_file.seek(int(offsets[row]))
+                record = json.loads(chunks_file.readline())
+                docs.append(Document(id=record["id"], page_content=record["text"], metadata=record["metadata"]))
+        return docs
+
+    def similarity_search_by_vectors(self, embeddings, k=4):
+        """Top-k documents for each of several query vectors, scored together one block of rows at a time."""
+        np = self.np
+        self.refresh()
+        with self.lock:
+            # One consistent snapshot, even if compact() swaps the files mid-search.
+            vectors, deleted, offsets, chunks_file, rows = (
+                self.vectors, self.deleted, self.offsets, self.chunks_file, self.rows)
+        if not rows or not len(embeddings):
+            return [[] for _ in embeddings]
+        queries = self._normalize(embeddings)
+        scores = np.empty((len(queries), rows), dtype=np.float32)
+        for start in range(0, rows, SEARCH_BLOCK_ROWS):
+            block = vectors[start:start + SEARCH_BLOCK_ROWS]
+            scores[:, start:start + len(block)] = queries @ block.astype(np.float32).T
+        scores[:, deleted.astype(bool)] = -np.inf
+
+        k = min(k, rows)
+        results = []
+        for query_scores, top in zip(scores, np.argpartition(-scores, k - 1, axis=1)[:, :k]):
+            top = top[np.argsort(-query_scores[top])]
+            results.append(self._documents([row for row in top if np.isfinite(query_scores[row])],
+                                           offsets, chunks_file))
+        return results
+
+    def similarity_search_by_vector(self, embedding, k=4):
+        return self.similarity_search_by_vectors([embedding], k)[0]
+
+    def similarity_search(self, query, k=4):
+        return self.similarity_search_by_vector(self.embeddings.embed_query(query), k)
+
+    def get(self, include=None, limit=None, offset=0):
+        """Live chunks in insertion order, in Chroma's get() result shape."""
+        with self.lock:
+            self.refresh()
+            # One vectorized pass over the tombstones, so paging through the store stays linear.
+            live = self.np.flatnonzero(self.np.asarray(self.deleted) == 0) if self.rows else []
+            rows = [int(row) for row in live[offset:offset + limit if limit is not None else None]]
+            docs = self._documents(rows)
+        return {
+            "ids": [doc.id for doc in docs],
+            "documents": [doc.page_content for doc in docs],
+            "metadatas": [doc.metadata for doc in docs],
+        }
+
+    def count(self):
+        self.refresh()
+        return int(self.rows - int(self.deleted.sum())) if self.rows else 0
+
+def vector_store_exists():
+    if VECTOR_BACKEND == "mmap":
+        return os.path.exists(os.path.join(MMAP_INDEX_PATH, "meta.json"))
+    return os.path.exists(CHROMA_PATH)
+
+def open_vector_store(embeddings=None, path=None):
+    """
+    The configured vector backend; `embeddings` may be None when only reading or deleting.
+    `path` overrides the backend's default location.
+    """
+    if VECTOR_BACKEND == "mmap":
+        return MmapVectorStore(path or MMAP_INDEX_PATH, embeddings)
+    from langchain_chroma import Chroma
+    return Chroma(persist_directory=path or CHROMA_PATH, embedding_function=embeddings)
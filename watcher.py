@@ -0,0 +1,205 @@
+import os
+import sys
+import time
+import errno
+import ctypes
+import select
+import struct
+import threading
+
+# Quiet period after the last change before a burst is handed to ingestion.
+WATCH_DEBOUNCE = float(os.getenv("WATCH_DEBOUNCE", 2.0))
+# Minimum seconds between two ingestion runs started by the watcher.
+WATCH_MIN_INTERVAL = float(os.getenv("WATCH_MIN_INTERVAL", 30.0))
+# Longest an ingestion run is postponed while chats are being answered.
+WATCH_MAX_DEFER = float(os.getenv("WATCH_MAX_DEFER", 120.0))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 5.0))
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE
+               | _IN_DELETE | _IN_DELETE_SELF | _IN_ATTRIB | _IN_MODIFY)
+_EVENT_HEADER = struct.Struct("iIII")
+
+class InotifySource:
+    """Recursive directory watch on Linux via inotify, called through libc with ctypes."""
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self.add_tree(root)
+
+    def add_tree(self, root):
+        for directory, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = directory
+
+    def wait(self, timeout):
+        """Return the set of paths that changed within `timeout` seconds, or None on queue overflow."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(sys.getfilesystemencoding(), "replace")
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if mask & _IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name) if name else directory
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self.add_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingSource:
+    """Portable fallback: compares (size, mtime) snapshots of the tree every `interval` seconds."""
+
+    def __init__(self, root, interval=WATCH_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        current = self.scan()
+        changed = {p for p in current.keys() | self.snapshot.keys() if current.get(p) != self.snapshot.get(p)}
+        self.snapshot = current
+        return changed
+
+    def close(self):
+        pass
+
+def open_source(root):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifySource(root)
+        except (OSError, AttributeError) as e:
+            print(f"inotify 不可用，改用轮询监视: {e}")
+    return PollingSource(root)
+
+class DataWatcher(threading.Thread):
+    """
+    Watches the data directory and feeds changed files into incremental ingestion.
+
+    Bursts of events are debounced into one batch. Runs are at least `min_interval`
+    apart and, while `is_busy()` is true (e.g. a chat is being answered), postponed
+    for up to WATCH_MAX_DEFER seconds so background ingestion does not slow it down.
+
+    Args:
+        root (str): Directory to watch.
+        ingest (callable): Called with the set of changed paths; None means "rescan everything".
+        is_busy (callable): Optional; returns True while ingestion should wait.
+    """
+
+    def __init__(self, root, ingest, is_busy=None, debounce=WATCH_DEBOUNCE, min_interval=WATCH_MIN_INTERVAL):
+        super().__init__(name="priestess-data-watcher", daemon=True)
+        self.root = root
+        self.ingest = ingest
+        self.is_busy = is_busy or (lambda: False)
+        self.debounce = debounce
+        self.min_interval = min_interval
+        self.stopped = threading.Event()
+        self.last_run = 0.0
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        source = open_source(self.root)
+        pending = set()
+        full_rescan = False
+        last_event = 0.0
+        try:
+            while not self.stopped.is_set():
+                changed = source.wait(timeout=0.5)
+                if changed is None:
+                    full_rescan = True
+                    last_event = time.monotonic()
+                elif changed:
+                    pending |= changed
+                    last_event = time.monotonic()
+
+                if not (pending or full_rescan) or time.monotonic() - last_event < self.debounce:
+                    continue
+                if time.monotonic() - self.last_run < self.min_interval:
+                    continue
+
+                self.wait_until_idle()
+                batch = None if full_rescan else pending
+                pending, full_rescan = set(), False
+                self.last_run = time.monotonic()
+                try:
+                    self.ingest(batch)
+                except Exception as e:
+                    print(f"自动导入失败: {e}")
+        finally:
+            source.close()
+
+    def wait_until_idle(self):
+        deadline = time.monotonic() + WATCH_MAX_DEFER
+        while self.is_busy() and time.monotonic() < deadline and not self.stopped.is_set():
+            time.sleep(0.5)
+
+if __name__ == "__main__":
+    import ingest
+
+    def run_ingest(paths):
+        print(f"检测到变化，开始导入: {sorted(paths) if paths else '全部'}")
+        ingest.create_vector_db(paths=paths)
+
+    watcher = DataWatcher(ingest.DATA_PATH, run_ingest)
+    watcher.start()
+    print(f"正在监视 {ingest.DATA_PATH}，按 Ctrl+C 退出。")
+    try:
+        while watcher.is_alive():
+            watcher.join(1)
+    except KeyboardInterrupt:
+        watcher.stop()